@@ -1,5 +1,5 @@
 
-import {waitUntilBucketExists} from '@aws-sdk/client-s3'
+import {waitUntilBucketExists, LifecycleRule} from '@aws-sdk/client-s3'
 import {waitUntilRoleExists} from '@aws-sdk/client-iam'
 import {GetFunctionCommandOutput, waitUntilFunctionExists, Runtime} from '@aws-sdk/client-lambda'
 
@@ -250,27 +250,10 @@ export class HostUserAws extends HostUserAwsBase implements HostUser {
             },
         })
 
-        // Generate list of expiry rules for possible lifespan values (1 day - 2 years)
-        // NOTE Limit is 1,000 rules
-        const rules = [...Array(365 * 2).keys()].map(n => n + 1).map(n => {
-            return {
-                Status: 'Enabled' as const,
-                Expiration: {Days: n},
-                Filter: {Tag: {Key: 'stello-lifespan', Value: `${n}`}},
-            }
-        })
-
-        // Include zero rule, just in case (shouldn't ever be used; 1 day value since 0 invalid)
-        rules.push({
-            Status: 'Enabled',
-            Expiration: {Days: 1},
-            Filter: {Tag: {Key: 'stello-lifespan', Value: '0'}},
-        })
-
         // Set expiry policies
         await this.s3.putBucketLifecycleConfiguration({
             Bucket: this.bucket,
-            LifecycleConfiguration: {Rules: rules},
+            LifecycleConfiguration: {Rules: this._lifespan_expiry_rules()},
         })
 
         // Set access policy
@@ -314,6 +297,32 @@ export class HostUserAws extends HostUserAwsBase implements HostUser {
                 Rules: [{ApplyServerSideEncryptionByDefault: {SSEAlgorithm: 'AES256'}}],
             },
         })
+
+        // Set expiry policies (read counts are tagged with their copy's lifespan)
+        await this.s3.putBucketLifecycleConfiguration({
+            Bucket: this._bucket_resp_id,
+            LifecycleConfiguration: {Rules: this._lifespan_expiry_rules()},
+        })
+    }
+
+    _lifespan_expiry_rules():LifecycleRule[]{
+        // Generate list of expiry rules for possible lifespan values (1 day - 2 years)
+        // NOTE Limit is 1,000 rules
+        const rules = [...Array(365 * 2).keys()].map(n => n + 1).map(n => {
+            return {
+                Status: 'Enabled' as const,
+                Expiration: {Days: n},
+                Filter: {Tag: {Key: 'stello-lifespan', Value: `${n}`}},
+            }
+        })
+
+        // Include zero rule, just in case (shouldn't ever be used; 1 day value since 0 invalid)
+        rules.push({
+            Status: 'Enabled',
+            Expiration: {Days: 1},
+            Filter: {Tag: {Key: 'stello-lifespan', Value: '0'}},
+        })
+        return rules
     }
 
     async _setup_gateway():Promise<void>{
@@ -373,10 +382,10 @@ export class HostUserAws extends HostUserAwsBase implements HostUser {
             {Effect: 'Allow', Resource: `${this._bucket_arn}/*`,
                 Action: ['s3:GetObjectTagging', 's3:PutObjectTagging', 's3:DeleteObject']},
 
-            // Put responses and list how many
+            // Put responses and list how many (and update/delete responder state)
             {Effect: 'Allow', Resource: this._bucket_resp_arn, Action: ['s3:ListBucket']},
             {Effect: 'Allow', Resource: `${this._bucket_resp_arn}/*`,
-                Action: ['s3:GetObject', 's3:PutObject']},
+                Action: ['s3:GetObject', 's3:PutObject', 's3:PutObjectTagging', 's3:DeleteObject']},
 
             // Publish notifications to SNS topic
             {Effect: 'Allow', Resource: await this._get_topic_arn(), Action: ['sns:Publish']},
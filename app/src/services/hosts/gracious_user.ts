@@ -63,6 +63,8 @@ export class HostUserGracious extends HostUserAwsBase implements HostUser {
         await this._delete_objects(this.bucket, `messages/${this.user}/`)
         await this._delete_objects(this.bucket, `config/${this.user}/`)
         await this._delete_objects(this._bucket_resp_id, `responses/${this.user}/`)
+        await this._delete_objects(this._bucket_resp_id, `state/${this.user}/`)
+        await this._delete_objects(this._bucket_resp_id, `pending_notifications/${this.user}/`)
         await this.s3.deleteObject({Bucket: this._bucket_resp_id, Key: `config/${this.user}/config`})
     }
 }
@@ -23,8 +23,8 @@ for (let n=0; n <= 365*2; n++){
 rules[0] = rules[0]!.replace('ExpirationInDays: 0', 'ExpirationInDays: 1')
 
 
-// Insert the rules into base template
-template = template.replace('MESSAGE_EXPIRY_RULES', rules.join('\n'))
+// Insert the rules into base template (for both messages and responder state)
+template = template.replace(/MESSAGE_EXPIRY_RULES/g, rules.join('\n'))
 
 
 // Insert the current version
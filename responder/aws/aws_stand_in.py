@@ -0,0 +1,272 @@
+"""In-memory stand-in for the AWS services (and Rollbar) the responder uses, for local testing
+
+Serves S3 (path-style REST), SES/SNS (query protocol) and Rollbar over HTTP on a local port, so the
+responder can be pointed at it via `stello_s3_endpoint`, `AWS_ENDPOINT_URL_SES/SNS` and
+`stello_rollbar_endpoint` and run unmodified with no network access or AWS credentials.
+
+"""
+
+import os
+import base64
+import random
+import hashlib
+from time import sleep
+from threading import Thread, RLock
+from email.utils import formatdate, parsedate_to_datetime
+from collections import Counter
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qsl, unquote
+from xml.sax.saxutils import escape
+from xml.etree import ElementTree
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+class AwsStandIn(ThreadingHTTPServer):
+    """In-memory stand-in for the S3, SES/SNS and Rollbar requests the responder makes"""
+
+    daemon_threads = True
+
+    def __init__(self, s3_latency=0, notify_latency=0, report_latency=0):
+        super().__init__(('127.0.0.1', 0), AwsStandInHandler)
+        self.s3_latency = s3_latency / 1000
+        self.notify_latency = notify_latency / 1000
+        self.report_latency = report_latency / 1000
+        self.objects = {}  # (bucket, key) -> {'body', 'etag', 'tags', 'modified'}
+        self.lock = RLock()
+        self.calls = Counter()  # By operation and key prefix
+        self.notifications = []  # Params of each SES/SNS request
+
+    @property
+    def endpoint(self):
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def start(self):
+        """Serve requests in a background thread"""
+        Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def put(self, bucket, key, body, tags=None):
+        with self.lock:
+            self.objects[(bucket, key)] = {
+                'body': body,
+                'etag': '"' + hashlib.md5(body).hexdigest() + '"',
+                'tags': tags or {},
+                'modified': formatdate(usegmt=True),
+            }
+
+    def record(self, operation, key):
+        """Count a call, grouping keys by prefix without user or object name"""
+        parts = key.split('/')
+        prefix = '/'.join(parts[:1] + parts[2:-1])
+        with self.lock:
+            self.calls[f'{operation} {prefix}'] += 1
+
+
+class AwsStandInHandler(BaseHTTPRequestHandler):
+    """Respond to S3 (path-style REST), SES/SNS (query protocol) and Rollbar requests"""
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass  # Far too many requests to log
+
+    def do_GET(self):
+        self._handle()
+
+    do_HEAD = do_GET
+    do_PUT = do_GET
+    do_POST = do_GET
+    do_DELETE = do_GET
+
+    def _handle(self):
+        body = self._read_body()
+        url = urlsplit(self.path)
+        query = dict(parse_qsl(url.query, keep_blank_values=True))
+
+        # SES and SNS requests are form posts to the root
+        if self.command == 'POST' and url.path == '/':
+            self._notify(body)
+            return
+
+        # Error reports
+        if url.path.startswith('/rollbar/'):
+            with self.server.lock:
+                self.server.calls['Rollbar (report)'] += 1
+            sleep(self.server.report_latency)
+            self._reply(200, b'{"err": 0, "result": {"uuid": "loadtest"}}',
+                {'content-type': 'application/json'})
+            return
+
+        sleep(self.server.s3_latency * random.uniform(0.5, 1.5))
+        bucket, _, key = unquote(url.path[1:]).partition('/')
+        if not key and self.command == 'GET':
+            self._list(bucket, query)
+        elif not key and 'delete' in query:
+            self._delete_objects(bucket, body)
+        elif 'tagging' in query:
+            self._get_tagging(bucket, key)
+        elif self.command in ('GET', 'HEAD'):
+            self._get_object(bucket, key)
+        elif self.command == 'PUT':
+            self._put_object(bucket, key, body)
+        elif self.command == 'DELETE':
+            self.server.record('DeleteObject', key)
+            with self.server.lock:
+                self.server.objects.pop((bucket, key), None)
+            self._reply(204)
+        else:
+            self._error(400, 'NotImplemented')
+
+    def _read_body(self):
+        """Read body, removing any HTTP and aws-chunked framing"""
+        if self.headers.get('transfer-encoding') == 'chunked':
+            body = b''
+            while size := int(self.rfile.readline().split(b';')[0], 16):
+                body += self.rfile.read(size)
+                self.rfile.readline()
+            while self.rfile.readline().strip():
+                pass  # Discard trailers
+        else:
+            body = self.rfile.read(int(self.headers.get('content-length') or 0))
+        if 'aws-chunked' in (self.headers.get('content-encoding') or ''):
+            data, pos = b'', 0
+            while size := int(body[pos:body.index(b'\r\n', pos)].split(b';')[0], 16):
+                pos = body.index(b'\r\n', pos) + 2
+                data += body[pos:pos+size]
+                pos += size + 2
+            body = data
+        return body
+
+    def _reply(self, status, body=b'', headers={}):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        if 'content-length' not in headers:
+            self.send_header('content-length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def _error(self, status, code):
+        body = f'<?xml version="1.0" encoding="UTF-8"?><Error><Code>{code}</Code></Error>'
+        self._reply(status, body.encode(), {'content-type': 'application/xml'})
+
+    def _xml(self, xml):
+        self._reply(200, ('<?xml version="1.0" encoding="UTF-8"?>' + xml).encode(),
+            {'content-type': 'application/xml'})
+
+    def _get_object(self, bucket, key):
+        self.server.record('HeadObject' if self.command == 'HEAD' else 'GetObject', key)
+        obj = self.server.objects.get((bucket, key))
+        if not obj:
+            self._error(404, 'NoSuchKey')
+        elif self.headers.get('if-none-match') == obj['etag']:
+            self._reply(304, headers={'etag': obj['etag']})
+        elif self.headers.get('if-match', obj['etag']) != obj['etag']:
+            self._error(412, 'PreconditionFailed')
+        else:
+            self._reply(200, obj['body'], {'etag': obj['etag'], 'last-modified': obj['modified'],
+                'content-length': str(len(obj['body']))})
+
+    def _put_object(self, bucket, key, body):
+        self.server.record('PutObject', key)
+        if_match = self.headers.get('if-match')
+        with self.server.lock:
+            obj = self.server.objects.get((bucket, key))
+            if if_match and not obj:
+                error = (404, 'NoSuchKey')
+            elif (obj and self.headers.get('if-none-match') == '*') or \
+                    (if_match and if_match != obj['etag']):
+                error = (412, 'PreconditionFailed')
+            else:
+                error = None
+                tags = dict(parse_qsl(self.headers.get('x-amz-tagging') or ''))
+                self.server.put(bucket, key, body, tags)
+                etag = self.server.objects[(bucket, key)]['etag']
+        if error:
+            self._error(*error)
+        else:
+            self._reply(200, headers={'etag': etag})
+
+    def _get_tagging(self, bucket, key):
+        self.server.record('GetObjectTagging', key)
+        obj = self.server.objects.get((bucket, key))
+        if not obj:
+            self._error(404, 'NoSuchKey')
+            return
+        tags = ''.join(f'<Tag><Key>{escape(k)}</Key><Value>{escape(v)}</Value></Tag>'
+            for k, v in obj['tags'].items())
+        self._xml(f'<Tagging><TagSet>{tags}</TagSet></Tagging>')
+
+    def _delete_objects(self, bucket, body):
+        keys = [el.text for el in ElementTree.fromstring(body).iter() if el.tag.endswith('Key')]
+        for key in keys:
+            self.server.record('DeleteObjects', key)
+        with self.server.lock:
+            for key in keys:
+                self.server.objects.pop((bucket, key), None)
+        self._xml('<DeleteResult></DeleteResult>')
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', '')
+        delimiter = query.get('delimiter')
+        after = query.get('continuation-token') or query.get('start-after') or ''
+        max_keys = int(query.get('max-keys', 1000))
+        self.server.record('ListObjectsV2', prefix)
+        with self.server.lock:
+            keys = sorted(k for b, k in self.server.objects
+                if b == bucket and k.startswith(prefix) and k > after)
+            objects = {k: self.server.objects[(bucket, k)] for k in keys}
+
+        # Group keys by delimiter, noting last key covered in case truncated
+        contents, prefixes, last = [], [], None
+        for key in keys:
+            if len(contents) + len(prefixes) == max_keys:
+                break
+            if last and key <= last:
+                continue  # Already covered by a common prefix
+            rest = key[len(prefix):]
+            if delimiter and delimiter in rest:
+                common = prefix + rest[:rest.index(delimiter) + 1]
+                prefixes.append(f'<CommonPrefixes><Prefix>{escape(common)}</Prefix></CommonPrefixes>')
+                last = common + '\U0010ffff'
+            else:
+                obj = objects[key]
+                contents.append(f'<Contents><Key>{escape(key)}</Key>'
+                    f'<LastModified>{_iso_time(obj["modified"])}</LastModified>'
+                    f'<ETag>{escape(obj["etag"])}</ETag><Size>{len(obj["body"])}</Size></Contents>')
+                last = key
+        truncated = any(key > last for key in keys) if last else False
+        token = f'<NextContinuationToken>{escape(last)}</NextContinuationToken>' if truncated else ''
+        self._xml(f'<ListBucketResult><Name>{bucket}</Name><Prefix>{escape(prefix)}</Prefix>'
+            f'<KeyCount>{len(contents) + len(prefixes)}</KeyCount><MaxKeys>{max_keys}</MaxKeys>'
+            f'<IsTruncated>{str(truncated).lower()}</IsTruncated>{token}'
+            + ''.join(contents) + ''.join(prefixes) + '</ListBucketResult>')
+
+    def _notify(self, body):
+        params = dict(parse_qsl(body.decode()))
+        action = params.get('Action', 'Unknown')
+        with self.server.lock:
+            self.server.calls[f'{action} (notify)'] += 1
+            self.server.notifications.append(params)
+        sleep(self.server.notify_latency * random.uniform(0.5, 1.5))
+        self._xml(f'<{action}Response><{action}Result><MessageId>loadtest</MessageId>'
+            f'</{action}Result></{action}Response>')
+
+
+def _iso_time(http_date):
+    return parsedate_to_datetime(http_date).strftime('%Y-%m-%dT%H:%M:%S.000Z')
+
+
+# HELPERS FOR SEEDING
+
+
+def url64(data):
+    return base64.urlsafe_b64encode(data).decode().replace('=', '~')
+
+
+def encrypt(secret, data):
+    iv = os.urandom(12)
+    return iv + AESGCM(secret).encrypt(iv, data, None)
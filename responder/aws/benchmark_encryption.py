@@ -0,0 +1,86 @@
+"""Compare CPU time and size of stored responses when using RSA vs X25519 key encapsulation
+
+Also compares loading the user's RSA key for every response (as before it was cached) to reusing
+the cached key and padding.
+
+Usage: python3 benchmark_encryption.py [iterations]
+
+NOTE Runs offline, only needing the responder's requirements (no AWS credentials or requests)
+
+"""
+
+import os
+import sys
+import json
+import base64
+from time import process_time
+from pathlib import Path
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.asymmetric.padding import OAEP, MGF1
+
+
+# Responder requires its env to be set, though nothing here uses the values
+for key in ('stello_env', 'stello_version', 'stello_msgs_bucket', 'stello_region',
+        'stello_rollbar_responder', 'stello_topic_arn'):
+    os.environ.setdefault(key, 'benchmark')
+sys.path.insert(0, str(Path(__file__).parent / 'function'))
+import responder
+
+
+def url64(data):
+    return base64.urlsafe_b64encode(data).decode().replace('=', '~')
+
+
+def main():
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+
+    # Same key types as the app generates
+    rsa_public = rsa.generate_private_key(65537, 4096).public_key()
+    x25519_public = X25519PrivateKey.generate().public_key()
+    configs = {
+        'rsa': {'resp_key_public': url64(rsa_public.public_bytes(Encoding.DER,
+            PublicFormat.SubjectPublicKeyInfo))},
+        'x25519': {'resp_key_x25519': url64(x25519_public.public_bytes(Encoding.Raw,
+            PublicFormat.Raw))},
+    }
+
+    # A typical reply
+    data = json.dumps({
+        'event': {'encrypted': 'x' * 200, 'content': 'Thanks for the update! ' * 10},
+        'ip': '203.0.113.1',
+    }).encode()
+
+    for resp_format in ('json', 'binary'):
+        for name, config in configs.items():
+            config = {**config, 'resp_format': resp_format}
+            responder._encrypt_resp(config, data)  # Warm up (e.g. key loading cache)
+            start = process_time()
+            for _ in range(iterations):
+                output = responder._encrypt_resp(config, data)
+            per_resp = (process_time() - start) / iterations * 1000
+            print(f"{resp_format:<6} {name:<6} {per_resp:8.3f} ms CPU  {len(output):6} bytes")
+
+    # Key loading, both uncached and fresh padding per response (before) and cached (after)
+    key = configs['rsa']['resp_key_public']
+    sym_key = os.urandom(32)
+    def before():
+        responder._load_public_key.__wrapped__(key).encrypt(sym_key,
+            OAEP(MGF1(SHA256()), SHA256(), None))
+    def after():
+        responder._load_public_key(key).encrypt(sym_key, responder.ASYM_PADDING)
+    print()
+    for name, load_and_encrypt in (('before', before), ('after', after)):
+        load_and_encrypt()  # Warm up
+        start = process_time()
+        for _ in range(iterations):
+            load_and_encrypt()
+        per_resp = (process_time() - start) / iterations * 1000
+        print(f"key load + wrap {name:<6} {per_resp:8.3f} ms CPU")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,116 @@
+"""Compact old response objects into segments so they can be downloaded in fewer requests
+
+Intended to be run on a schedule (handler `compactor.entry`) with the same env as the responder
+
+Each segment is stored at `segments/{user}/{timestamp}_{uuid}` and consists of:
+    A single line of JSON: {'version': 1, 'index': [[path, offset, length], ...]}
+    Followed by the original response objects concatenated together
+
+`path` is the response's original key relative to `responses/{user}/` (so includes its type and
+timestamp) and `offset` is relative to the end of the index line. Response objects are stored
+unmodified so are still individually encrypted exactly as the app expects.
+
+Segments are outside of `responses/` so that apps which don't support them never list them
+(their responses are just delayed until the app is updated rather than reported as invalid)
+
+WARN Does nothing unless `stello_compact_responses` is set, which should only be done once the app
+    can download segments (and has permission to list, get and delete them)
+
+"""
+
+import os
+import json
+from time import time
+from uuid import uuid4
+from itertools import takewhile
+
+from responder import (S3, EXECUTOR, RESP_BUCKET, VALID_TYPES, _instrumented, _flushes_reports,
+    _deadline, _report_error, _list_resp_keys)
+
+
+COMPACT_MIN_AGE = 60 * 60 * 24  # Only compact responses the app hasn't downloaded for a while
+COMPACT_MIN_OBJECTS = 50  # Not worth creating a segment for fewer responses than this
+SEGMENT_MAX_OBJECTS = 1000  # Also the max that can be deleted in a single request
+COMPACT_ENABLED = bool(os.environ.get('stello_compact_responses'))
+
+
+@_instrumented
+@_flushes_reports
+def entry(event, context):
+    """Compact responses of all users, until all done or running out of time"""
+    if not COMPACT_ENABLED:
+        return
+    deadline = _deadline(context)
+    for user in _list_users():
+        for resp_type in VALID_TYPES:
+            if deadline and time() > deadline:
+                return
+            try:
+                _compact(user, resp_type, deadline)
+            except:
+                _report_error({})
+
+
+def _list_users():
+    """Yield all users that have responses stored"""
+    paginator = S3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=RESP_BUCKET, Prefix='responses/', Delimiter='/'):
+        for prefix in page.get('CommonPrefixes', []):
+            yield prefix['Prefix'].split('/')[1]
+
+
+def _compact(user, resp_type, deadline):
+    """Compact old responses of given type into as many segments as needed"""
+
+    # Get keys of old responses (listed in order of timestamp so can stop at first new one)
+    cutoff = time() - COMPACT_MIN_AGE
+    keys = list(takewhile(lambda key: int(key.split('/')[-1].split('_')[0]) < cutoff,
+        _list_resp_keys(user, resp_type)))
+
+    # Compact into segments, leaving any remainder too small for a segment till next time
+    for start in range(0, len(keys), SEGMENT_MAX_OBJECTS):
+        chunk = keys[start:start+SEGMENT_MAX_OBJECTS]
+        if len(chunk) < COMPACT_MIN_OBJECTS or (deadline and time() > deadline):
+            return
+        _write_segment(user, chunk)
+
+
+def _download(key):
+    """Download a response object, returning None if it no longer exists"""
+    try:
+        return S3.get_object(Bucket=RESP_BUCKET, Key=key)['Body'].read()
+    except S3.exceptions.NoSuchKey:
+        return None  # App may have just downloaded and deleted it
+
+
+def _write_segment(user, keys):
+    """Combine given response objects into a segment and then delete them"""
+
+    # Download responses in parallel
+    objects = [(k, body) for k, body in zip(keys, EXECUTOR.map(_download, keys)) if body]
+    if not objects:
+        return
+
+    # Form index and store segment
+    index = []
+    offset = 0
+    user_prefix_len = len(f'responses/{user}/')
+    for key, body in objects:
+        index.append([key[user_prefix_len:], offset, len(body)])
+        offset += len(body)
+    header = json.dumps({'version': 1, 'index': index}).encode() + b'\n'
+    segment_key = f'segments/{user}/{int(time())}_{uuid4()}'
+    S3.put_object(Bucket=RESP_BUCKET, Key=segment_key,
+        Body=header + b''.join(body for _, body in objects))
+
+    # Delete originals in one request, removing segment if can't so responses aren't duplicated
+    try:
+        resp = S3.delete_objects(Bucket=RESP_BUCKET, Delete={'Quiet': True,
+            'Objects': [{'Key': key} for key, _ in objects]})
+    except:
+        S3.delete_object(Bucket=RESP_BUCKET, Key=segment_key)
+        raise
+
+    # If only some failed, keeping segment is better than losing the ones that were deleted
+    if resp.get('Errors'):
+        raise Exception(f"Failed to delete {len(resp['Errors'])} compacted responses")
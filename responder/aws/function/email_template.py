@@ -1,8 +1,7 @@
 
+import os
 import html
 
-from email_image import base64_image
-
 
 email_template = '''
 <html>
@@ -22,7 +21,7 @@ email_template = '''
 <body style="padding-top:4px;padding-bottom:150px">
     <div style="border-radius:12px;max-width:600px;margin:0 auto;background-color:rgba(127,127,127,0.15)">
         <a href="stello://responses">
-            <img src="data:image/jpeg;base64,{image}" height="150" width="600"
+            <img src="{image}" height="150" width="600"
                 style="border-radius: 12px 12px 0 0; width: 100%; height: auto; border-bottom: 1px solid #cccccc;max-height: 150px; background-color: #ddeeff">
         </a>
         <div style="padding:16px">
@@ -63,7 +62,23 @@ email_template = '''
 </html>
 '''
 
+# Link to image if hosted, as otherwise embedding it adds ~22 KB to every email
+# NOTE Some email clients also block data URIs
+EMAIL_IMAGE_URL = os.environ.get('stello_email_image_url')
+if EMAIL_IMAGE_URL:
+    image_src = EMAIL_IMAGE_URL
+else:
+    from email_image import base64_image
+    image_src = 'data:image/jpeg;base64,' + base64_image
+
+
+# Render static parts of template just once, so only need to join them with content per email
+_rendered = email_template.format(image=image_src, heading='\0heading\0', body='\0body\0')
+_start, _, _rest = _rendered.partition('\0heading\0')
+_middle, _, _end = _rest.partition('\0body\0')
+
+
 def generate_email(heading, body):
     heading = html.escape(heading)
     body = html.escape(body).replace('\n', '<br>')
-    return email_template.format(heading=heading, body=body, image=base64_image)
+    return ''.join((_start, heading, _middle, body, _end))
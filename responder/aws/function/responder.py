@@ -1,27 +1,98 @@
 
 import os
+import re
+import sys
 import json
+import zlib
 import base64
-import string
-from time import time
+import heapq
+import random
+import hashlib
+from copy import deepcopy
+from time import time, sleep, perf_counter, monotonic
 from uuid import uuid4
 from pathlib import Path
 from traceback import format_exc
-from contextlib import suppress
+from contextlib import suppress, contextmanager
+from threading import Lock
+from functools import lru_cache, wraps
+from collections import OrderedDict, Counter
+from concurrent.futures import ThreadPoolExecutor, Future, wait
 
-import rollbar
 import boto3
 from botocore.config import Config
+from botocore.exceptions import ClientError
 from cryptography.hazmat.primitives.hashes import SHA256
-from cryptography.hazmat.primitives.serialization import load_der_public_key
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.serialization import load_der_public_key, Encoding, PublicFormat
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.asymmetric.padding import OAEP, MGF1
-
-from email_template import generate_email
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
 
 
 # Constants
 VALID_TYPES = ('read', 'reply', 'reaction', 'subscription', 'address', 'resend', 'subscribe')
+COUNTED_TYPES = ('reply', 'resend', 'subscribe', 'reaction')  # Counted for notifications
+RESP_COUNTS_MAX_AGE = 60 * 60 * 24  # Rebuild counts at least daily in case of any drift
+STATE_RETRIES = 10  # Max attempts at conditionally updating a state object
+STATE_BACKOFF = (0.02, 0.5)  # Seconds (base, max) to randomly wait up to between attempts
+RESP_PARTITIONS_MAX = 256  # Max value of `resp_partitions` in config (partitions are 2 hex digits)
+BATCH_MAX = 10  # Max events in a single batch request
+DEADLINE_MARGIN = 1  # Seconds to leave for responding and reporting errors before lambda timeout
+MAX_BODY_BYTES = 512 * 1024  # Max size of request body (both before and after decompressing)
+
+
+# Rate limits for shedding abusive load as (tokens added per second, max tokens)
+# NOTE Applied per warm container, and self-hosted recipients all have the same user
+RATE_LIMITS = {
+    'ip': (5, 100),
+    'user': (100, 1000),
+    'copy': (1, 30),
+}
+NOTIFY_FOOTER = (
+    "#### MESSAGE END ####\n"
+    "Open Stello to identify who responded and to reply to them"
+    " (not possible via email for security reasons)."
+    " Ignore storage provider's notes below."
+    " Instead, change notification settings in Stello."
+)
+
+
+# Fields the responder relies on for each event type, as {key: (types, required, pattern)}
+# NOTE Events may have other fields too, they just aren't used by the responder
+# NOTE Patterns only apply to string values and must match the whole value
+URL64_PATTERN = r'[A-Za-z0-9_~-]+'
+EVENT_SCHEMAS = {
+    '*': {
+        'config_secret': (str, True, URL64_PATTERN),
+        'encrypted': (str, True, None),
+    },
+    'read': {
+        'copy_id': (str, True, URL64_PATTERN),
+        'has_max_reads': (bool, True, None),
+    },
+    'reply': {
+        'content': (str, False, None),
+    },
+    'reaction': {
+        # SECURITY Prevents inserting long messages as a "reaction" but allows future codes too
+        #   Noting user may have enabled notifications for reactions, putting their value in emails
+        'content': ((str, type(None)), False, r'[A-Za-z0-9_-]{1,25}'),
+    },
+    'resend': {
+        'content': (str, False, None),
+    },
+    'subscribe': {
+        'form': (str, True, None),
+        'address': (str, False, None),
+        'name': (str, False, None),
+        'content': (str, False, None),
+    },
+}
+BATCH_SCHEMA = {
+    'config_secret': (str, True, URL64_PATTERN),
+    'events': (list, True, None),
+}
 
 
 # A base64-encoded 3w1h solid #ddeeff jpeg
@@ -34,6 +105,52 @@ SYM_TAG_BITS = 128  # Tag is 128 bits by default in AESGCM and not configurable
 SYM_KEY_BITS = 256
 
 
+# Asym encryption settings (same as js version)
+ASYM_PADDING = OAEP(MGF1(SHA256()), SHA256(), None)
+
+
+# Key encapsulation settings (used instead of RSA if config has `resp_key_x25519`)
+# Sym key is derived via HKDF from an ECDH exchange between an ephemeral key and user's key
+# NOTE Info binds derived key to both public keys, as they are not otherwise authenticated
+KEM_INFO_PREFIX = b'stello-resp-x25519'
+
+
+# Binary response format (used instead of JSON if config has `resp_format: 'binary'`)
+# Layout: magic, version, flags, key length (2 bytes), key (see flags), iv, encrypted data
+# NOTE Magic distinguishes from JSON format, which always starts with '{'
+RESP_BINARY_MAGIC = 0xB7
+RESP_BINARY_VERSION = 1
+RESP_FLAG_DEFLATE = 0b1  # Data was compressed with zlib before encrypting
+RESP_FLAG_X25519 = 0b10  # Key field is an ephemeral X25519 public key rather than RSA encrypted
+RESP_COMPRESS_MIN_BYTES = 1024  # Smaller data unlikely to benefit from compression
+
+
+# Warm container cache of decrypted configs
+# NOTE Config changes (e.g. disabling replies) may take up to TTL seconds to take effect
+CONFIG_CACHE_TTL = 60
+CONFIG_CACHE_SIZE = 100
+CONFIG_CACHE_STATS = {'hit': 0, 'miss': 0, 'revalidated': 0}
+_config_cache = OrderedDict()  # (user, secret_hash) -> (etag, config, checked)
+
+
+# Warm container cache of decrypted invite images (already base64 encoded for responding)
+INVITER_CACHE_BYTES = 4 * 1024 * 1024  # Small as lambdas may only have 128 MB in total
+EXPIRED_IMAGE_MAX_AGE = 5 * 60  # Expired images never change, but S3 errors could be transient
+_inviter_cache = OrderedDict()  # (bucket_key, secret_hash) -> (s3_etag, body)
+_cache_lock = Lock()  # Caches may be used by multiple threads when running as a server
+
+
+# Error reporting (done in the background so it never delays responding)
+REPORT_DEDUPE_WINDOW = 60 * 60  # Identical errors only sent once per window (rest are counted)
+REPORT_LIMIT = (1 / 60, 10)  # Max reports of the same error as (per second, burst)
+REPORT_TIMEOUT = 3  # Seconds to wait for Rollbar to accept a report
+REPORT_FLUSH_MAX = 0.25  # Max seconds to delay ending invocation for (rest sent during next)
+REPORT_SEEN_MAX = 100  # Max distinct errors to remember for deduping
+_reports_seen = OrderedDict()  # fingerprint -> (last_sent, suppressed)
+_reports_pending = []  # Futures of reports not yet sent
+_reports_lock = Lock()
+
+
 # Config from env
 ENV = os.environ['stello_env']
 DEV = ENV == 'development'
@@ -42,6 +159,8 @@ MSGS_BUCKET = os.environ['stello_msgs_bucket']
 RESP_BUCKET = MSGS_BUCKET + '-stello-resp'
 REGION = os.environ['stello_region']
 ROLLBAR_TOKEN = os.environ['stello_rollbar_responder']  # Client token (not server) as public
+ROLLBAR_ENDPOINT = os.environ.get('stello_rollbar_endpoint')  # Optional, e.g. a local stand-in
+IN_LAMBDA = 'AWS_LAMBDA_FUNCTION_NAME' in os.environ  # Otherwise running as a server
 
 # Optional config
 SELF_HOSTED = not os.environ.get('stello_domain_branded')
@@ -51,35 +170,254 @@ else:
     DOMAIN_BRANDED = os.environ['stello_domain_branded']
     DOMAIN_UNBRANDED = os.environ['stello_domain_unbranded']
 
+# Optionally combine notifications into digests (seconds without new ones before sending)
+DIGEST_WINDOW = int(os.environ.get('stello_notify_digest_window', 0))
+DIGEST_MAX = int(os.environ.get('stello_notify_digest_max', 50))  # Send early if this many
+DIGEST_FLUSH_TIMEOUT = 60  # Seconds after which a digest's flush is assumed to have failed
+
+# Optionally allow clients to cache invite images for given seconds (otherwise never cached)
+INVITER_MAX_AGE = int(os.environ.get('stello_inviter_max_age', 0))
+
+# Optionally keep manifests of stored responses so app can get new ones without listing all
+RESP_MANIFEST = bool(os.environ.get('stello_resp_manifest'))
+MANIFEST_PERIOD = 15 * 60  # Seconds covered by each manifest
+MANIFEST_WRITER = uuid4().hex  # Each container writes its own manifests, so rarely conflict
 
-# Setup Rollbar
-# WARN Must use blocking handler, otherwise lambda may finish before report is sent
-# NOTE Version prefixed with 'v' so that traces match github tags
-# SECURITY Don't expose local vars in report as could contain sensitive user content
-rollbar.init(ROLLBAR_TOKEN, ENV, handler='blocking', code_version='v'+VERSION,
-    locals={'enabled': False}, root=str(Path(__file__).parent), enabled=not DEV)
-def _rollbar_add_context(payload, **kwargs):
-    payload['data']['platform'] = 'client'  # Allow client token rather than server, since public
-    return payload
-rollbar.events.add_payload_handler(_rollbar_add_context)
+# Optionally use an S3-compatible service rather than AWS (e.g. when self-hosting via server.py)
+S3_ENDPOINT = os.environ.get('stello_s3_endpoint') or None
+ALLOWED_ORIGIN = os.environ.get('stello_allowed_origin')  # Where displayer served from if not S3
+
+# Optionally log timings of each stage of processing (in CloudWatch embedded metric format)
+METRICS_ENABLED = bool(os.environ.get('stello_metrics'))
+
+# Optionally profile a fraction of requests (e.g. 0.01), logging summaries or saving to a dir
+PROFILE_RATE = float(os.environ.get('stello_profile_rate', 0))
+PROFILE_DIR = os.environ.get('stello_profile_dir')
+PROFILE_TOP = 20  # Number of functions and allocation sites to include in summaries
 
 
 # Access to AWS services
 # NOTE Important to set region to avoid unnecessary redirects for e.g. s3
-AWS_CONFIG = Config(region_name=REGION)
-S3 = boto3.client('s3', config=AWS_CONFIG)
+# NOTE Timeouts kept well within lambda's own timeout so retries can still happen
+AWS_CONFIG = Config(region_name=REGION, connect_timeout=2, read_timeout=5,
+    retries={'mode': 'standard', 'max_attempts': 3}, max_pool_connections=10)
+# Needed by all requests so create during init
+S3 = boto3.client('s3', config=AWS_CONFIG, endpoint_url=S3_ENDPOINT)
+
+# Threads for doing AWS requests in parallel (shared by warm invocations)
+EXECUTOR = ThreadPoolExecutor(max_workers=AWS_CONFIG.max_pool_connections)
+
+# Thread for sending error reports (separate so can't hold up AWS requests)
+REPORTER = ThreadPoolExecutor(max_workers=1)
+
+
+@lru_cache(maxsize=None)
+def _aws_client(service):
+    """Return client for an AWS service that isn't always needed (created once per container)"""
+    client = boto3.client(service, config=AWS_CONFIG)
+    client.meta.events.register('before-call', _count_aws_call)
+    return client
+
+
+# Instrumentation of current request
+# NOTE AWS calls logged in development so can see if a change adds any round trips
+AWS_CALLS = Counter()  # By service and operation
+_timings = {}  # Milliseconds by stage of processing (only if metrics enabled)
+_metric_props = {}  # Details like response type and cache results (only if metrics enabled)
+_metrics_lock = Lock()  # Requests may be processed by multiple threads
+def _count_aws_call(model, **kwargs):
+    with _metrics_lock:
+        AWS_CALLS[f'{model.service_model.service_name}.{model.name}'] += 1
+S3.meta.events.register('before-call', _count_aws_call)
+
+
+@contextmanager
+def _timed(stage):
+    """Time a stage of processing the current request (if metrics enabled)"""
+    if not METRICS_ENABLED:
+        yield
+        return
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        with _metrics_lock:
+            _timings[stage] = _timings.get(stage, 0) + (perf_counter() - start) * 1000
+
+
+def _metric_prop(key, value):
+    """Record a detail of the current request to include with its metrics (if enabled)"""
+    if METRICS_ENABLED:
+        _metric_props[key] = value
+
+
+def _instrumented(entrypoint):
+    """Decorator that logs AWS calls (in development) and metrics (if enabled) for entrypoint
+
+    Metrics are printed in CloudWatch's embedded metric format so need no extra API calls
+    https://docs.aws.amazon.com/AmazonCloudWatch/latest/monitoring/CloudWatch_Embedded_Metric_Format_Specification.html
+
+    """
+    if not DEV and not METRICS_ENABLED:
+        return entrypoint
+    @wraps(entrypoint)
+    def wrapper(*args):
+        AWS_CALLS.clear()
+        _timings.clear()
+        _metric_props.clear()
+        try:
+            with _timed('total'):
+                return entrypoint(*args)
+        finally:
+            if DEV:
+                print(json.dumps({'aws_calls': AWS_CALLS}))
+            if METRICS_ENABLED:
+                metrics = [{'Name': k, 'Unit': 'Milliseconds'} for k in _timings]
+                metrics += [{'Name': k, 'Unit': 'Count'} for k in AWS_CALLS]
+                print(json.dumps({
+                    '_aws': {
+                        'Timestamp': int(time() * 1000),
+                        'CloudWatchMetrics': [{
+                            'Namespace': 'Stello/Responder',
+                            'Dimensions': [['type']] if 'type' in _metric_props else [[]],
+                            'Metrics': metrics,
+                        }],
+                    },
+                    **_timings,
+                    **AWS_CALLS,
+                    **_metric_props,
+                }))
+    return wrapper
+
+
+@lru_cache(maxsize=None)
+def _rollbar():
+    """Return Rollbar module, only importing and setting it up once an error needs reporting"""
+    import rollbar
+
+    # NOTE Blocking handler as reports are already sent from the reporter thread (which then
+    #   knows when they're done, whereas Rollbar's own threads could be frozen with the lambda)
+    # NOTE Version prefixed with 'v' so that traces match github tags
+    # SECURITY Don't expose local vars in report as could contain sensitive user content
+    endpoint = {'endpoint': ROLLBAR_ENDPOINT} if ROLLBAR_ENDPOINT else {}
+    rollbar.init(ROLLBAR_TOKEN, ENV, handler='blocking', code_version='v'+VERSION,
+        locals={'enabled': False}, root=str(Path(__file__).parent), enabled=not DEV,
+        timeout=REPORT_TIMEOUT, **endpoint)
+    def _rollbar_add_context(payload, **kwargs):
+        payload['data']['platform'] = 'client'  # Allow client token rather than server
+        return payload
+    rollbar.events.add_payload_handler(_rollbar_add_context)
+    return rollbar
+
+
+def _flushes_reports(entrypoint):
+    """Decorator that waits for error reports to be sent before entrypoint's invocation ends
+
+    Lambda freezes the container once the invocation ends, so reports could otherwise be delayed
+    until the next invocation (or lost if there never is one). Only waits briefly, as responding
+    is delayed until this returns, and any still unsent will continue during the next invocation.
+    But if the invocation itself failed then waits as long as time remains, as the container may
+    never be invoked again (and the failure may be why).
+
+    """
+    if not IN_LAMBDA:
+        return entrypoint  # Reporter thread never frozen when running as a server
+    @wraps(entrypoint)
+    def wrapper(event, context):
+        try:
+            result = entrypoint(event, context)
+        except:
+            _flush_reports(_deadline(context))
+            raise
+        deadline = time() + REPORT_FLUSH_MAX
+        _flush_reports(min(deadline, _deadline(context) or deadline))
+        return result
+    return wrapper
+
+
+def _profiled(entrypoint):
+    """Decorator that profiles a random sample of invocations (if enabled)
 
+    Summarises top functions by cumulative time and top lines by memory allocated
+    NOTE Only covers the invocation's own thread, not work done in the executor's threads
+    SECURITY Only the request's path is recorded, never its contents (nor any other values)
+
+    """
+    if not PROFILE_RATE:
+        return entrypoint
+    import cProfile
+    import tracemalloc
+    profiling = Lock()  # Profilers are process-wide, so only one invocation at a time
+    @wraps(entrypoint)
+    def wrapper(event, context):
+        if random.random() >= PROFILE_RATE or not profiling.acquire(blocking=False):
+            return entrypoint(event, context)
+        profiler = cProfile.Profile()
+        start = perf_counter()
+        tracemalloc.start()
+        try:
+            with profiler:
+                return entrypoint(event, context)
+        finally:
+            # NOTE Failing to profile must never replace the invocation's result (or exception)
+            try:
+                duration = (perf_counter() - start) * 1000
+                snapshot = tracemalloc.take_snapshot()
+                peak = tracemalloc.get_traced_memory()[1]
+                tracemalloc.stop()
+                _save_profile(event, duration, profiler, snapshot, peak)
+            except:
+                tracemalloc.stop()
+                _report_error({})
+            finally:
+                profiling.release()
+    return wrapper
+
+
+def _save_profile(event, duration, profiler, snapshot, peak):
+    """Log a compact summary of a profile, or save it to the profile dir if set"""
+    import pstats
+    stats = pstats.Stats(profiler).stats  # (file, line, func) -> (cc, calls, tottime, cumtime, _)
+    functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:PROFILE_TOP]
+    allocations = snapshot.statistics('lineno')[:PROFILE_TOP]
+    summary = {'profile': {
+        'path': event.get('requestContext', {}).get('http', {}).get('path'),
+        'ms': round(duration, 1),
+        'peak_kb': round(peak / 1024, 1),
+        # [function, calls, own ms, cumulative ms]
+        'functions': [[f'{Path(file).name}:{line}({func})', calls, round(own * 1000, 2),
+            round(cum * 1000, 2)] for (file, line, func), (_, calls, own, cum, _) in functions],
+        # [line, KiB, allocations]
+        'allocations': [[f'{Path(stat.traceback[0].filename).name}:{stat.traceback[0].lineno}',
+            round(stat.size / 1024, 1), stat.count] for stat in allocations],
+    }}
+    if PROFILE_DIR:
+        Path(PROFILE_DIR, f'{int(time())}_{uuid4()}.json').write_text(json.dumps(summary))
+    else:
+        print(json.dumps(summary))
 
+
+@_instrumented
+@_flushes_reports
+@_profiled
 def entry(api_event, context):
     """Entrypoint that wraps main logic to add exception handling and CORS headers"""
 
+    # Events not from API Gateway can only be direct invocations (e.g. a schedule) to warm up
+    if 'requestContext' not in api_event:
+        return warm_up(api_event)
+
     # Handle GET requests (which don't send origin header so can't detect user)
     if api_event['requestContext']['http']['method'] == 'GET':
         try:
             if api_event['requestContext']['http']['path'] == '/inviter/image':
+                # NOTE Not limited by IP, as email providers fetch images for many recipients via
+                #   a few proxies (so instead limited per copy, which a single recipient can't evade)
                 return inviter_image(api_event)
             # NOTE A number of companies crawl AWS services, so don't warn for invalid paths
             raise Abort()
+        except RateLimited:
+            return {'statusCode': 429}
         except Abort:
             return {'statusCode': 400}
         except:
@@ -89,16 +427,17 @@ def entry(api_event, context):
 
     # Determine expected origin (and detect user)
     # NOTE Access-Control-Allow-Origin can only take one value, so must detect right one
-    if SELF_HOSTED:
-        user = '_user'
-        allowed_origin = f'https://{MSGS_BUCKET}.s3-{REGION}.amazonaws.com'
-    else:
-        # Hosted setup -- origin must be a subdomain of one of defined domains
-        user, _, root_origin = api_event['headers']['origin'].partition('//')[2].partition('.')
-        allowed_root = DOMAIN_BRANDED
-        if root_origin == DOMAIN_UNBRANDED:
-            allowed_root = DOMAIN_UNBRANDED
-        allowed_origin = f'https://{user}.{allowed_root}'
+    with _timed('origin'):
+        if SELF_HOSTED:
+            user = '_user'
+            allowed_origin = ALLOWED_ORIGIN or f'https://{MSGS_BUCKET}.s3-{REGION}.amazonaws.com'
+        else:
+            # Hosted setup -- origin must be a subdomain of one of defined domains
+            user, _, root_origin = api_event['headers']['origin'].partition('//')[2].partition('.')
+            allowed_root = DOMAIN_BRANDED
+            if root_origin == DOMAIN_UNBRANDED:
+                allowed_root = DOMAIN_UNBRANDED
+            allowed_origin = f'https://{user}.{allowed_root}'
 
     # If origin not allowed, 403 to prevent further processing of the request
     if not DEV and api_event['headers']['origin'] != allowed_origin:
@@ -106,7 +445,9 @@ def entry(api_event, context):
 
     # Process event and catch exceptions
     try:
-        response = _entry(api_event, user)
+        response = _entry(api_event, user, context)
+    except RateLimited:
+        response = {'statusCode': 429}
     except Abort:
         response = {'statusCode': 400}
     except:
@@ -128,7 +469,7 @@ def entry(api_event, context):
     return response
 
 
-def _entry(api_event, user):
+def _entry(api_event, user, context):
     """Main processing logic
     NOTE api_event format and response expected below
     https://docs.aws.amazon.com/apigateway/latest/developerguide/http-api-develop-integrations-lambda.html
@@ -155,28 +496,43 @@ def _entry(api_event, user):
 
     # Handle POST requests
     ip = api_event['requestContext']['http']['sourceIp']
-    event = json.loads(api_event['body'])
-
-    # These keys are required for all responses
-    _ensure_type(event, 'config_secret', str)
-    _ensure_type(event, 'encrypted', str)
-
-    # Load config (required to encrypt stored data, so can't do anything without)
-    config = _get_config(user, event['config_secret'])
+    _rate_limit('ip', ip)
+    _rate_limit('user', user)
+    with _timed('parse'):
+        event = json.loads(_decode_body(api_event))
+    if isinstance(event, dict) and isinstance(event.get('copy_id'), str):
+        _rate_limit('copy', f"{user}/{event['copy_id']}")
 
     # Get event type from path
     resp_type = api_event['requestContext']['http']['path'].partition('/responder/')[2]
+    _metric_prop('type', resp_type)
+    if resp_type == 'batch':
+        return _entry_batch(api_event, user, ip, event, context)
     if resp_type not in VALID_TYPES:
         raise Exception(f"Invalid value for response type: {resp_type}")
 
-    # Handle the event and then store it
-    handler = globals()[f'handle_{resp_type}']
-    handler(user, config, event)
-    _put_resp(config, resp_type, event, ip, user)
+    # Validate all that can be before needing config, so invalid requests cost no AWS requests
+    EVENT_VALIDATORS[resp_type](event)
+
+    # Load config (required to encrypt stored data, so can't do anything without)
+    config = _get_config(user, event['config_secret'])
 
-    # See if should send notification (failure reported but shouldn't impact response status)
+    # Handle the event
+    handler = globals()[f'handle_{resp_type}']
+    with _timed('handler'):
+        handler(user, config, event)
+
+    # Store it while also seeing if should send notification
+    # NOTE Notification failure reported but shouldn't impact response status
+    deadline = _deadline(context)
+    # NOTE Notification can be sent as soon as stored, while counts etc. are still being updated
+    stored = Future()
+    counted = EXECUTOR.submit(_put_resp, config, resp_type, event, ip, user, stored)
+    notified = EXECUTOR.submit(_send_notification, config, resp_type, event, user, stored,
+        counted)
+    _wait(counted, deadline)
     try:
-        _send_notification(config, resp_type, event, user)
+        _wait(notified, deadline)
     except:
         _report_error(api_event)
 
@@ -184,6 +540,90 @@ def _entry(api_event, user):
     return {'statusCode': 200}
 
 
+def _entry_batch(api_event, user, ip, batch, context):
+    """Process multiple events that share a config secret, reporting the status of each
+
+    SECURITY Only a status code is reported for each event, never any details
+
+    Batch data is expected to be: {
+        'config_secret': string,
+        'events': [{'type': string, 'encrypted': string, ...}, ...],
+    }
+
+    Response body is: {'results': [200 | 400 | 429, ...]}
+
+    """
+
+    # Validate batch itself
+    BATCH_VALIDATOR(batch)
+    if not 0 < len(batch['events']) <= BATCH_MAX:
+        raise Exception("Invalid number of events in batch")
+
+    # Validate each event as much as possible before needing config
+    statuses = []
+    valid = []
+    for item in batch['events']:
+        try:
+            if not isinstance(item, dict):
+                raise Exception("Invalid batch item")
+            resp_type = item.pop('type', None)
+            if resp_type not in VALID_TYPES:
+                raise Exception(f"Invalid value for response type: {resp_type}")
+            # Stored event is same as if sent individually (and so is limited the same)
+            event = {**item, 'config_secret': batch['config_secret']}
+            EVENT_VALIDATORS[resp_type](event)
+            if 'copy_id' in event:
+                _rate_limit('copy', f"{user}/{event['copy_id']}")
+        except RateLimited:
+            statuses.append(429)
+        except:
+            _report_error(api_event)
+            statuses.append(400)
+        else:
+            statuses.append(None)
+            valid.append((len(statuses) - 1, resp_type, event))
+    if not valid:
+        return {'statusCode': 200, 'body': json.dumps({'results': statuses})}
+
+    # Load config once for all events
+    config = _get_config(user, batch['config_secret'])
+
+    # Handle each event in order (e.g. subscription change may depend on a read)
+    handled = []
+    for index, resp_type, event in valid:
+        try:
+            globals()[f'handle_{resp_type}'](user, config, event)
+        except Abort:
+            statuses[index] = 400
+        except:
+            _report_error(api_event)
+            statuses[index] = 400
+        else:
+            statuses[index] = 200
+            handled.append((index, resp_type, event))
+
+    # Store responses in parallel
+    deadline = _deadline(context)
+    futures = [(index, EXECUTOR.submit(_put_resp, config, resp_type, event, ip, user))
+        for index, resp_type, event in handled]
+    for index, future in futures:
+        try:
+            _wait(future, deadline)
+        except:
+            _report_error(api_event)
+            statuses[index] = 400
+
+    # See if should send notifications (failure reported but shouldn't impact response status)
+    for index, resp_type, event in handled:
+        if statuses[index] == 200:
+            try:
+                _send_notification(config, resp_type, event, user)
+            except:
+                _report_error(api_event)
+
+    return {'statusCode': 200, 'body': json.dumps({'results': statuses})}
+
+
 # POST HANDLERS
 
 
@@ -199,43 +639,47 @@ def handle_read(user, config, event):
 
     """
 
-    # Expected fields
+    # NOTE Expected fields already validated by schema
     # SECURITY Yes attacker could change these value themselves but see above
-    _ensure_type(event, 'copy_id', str)
-    _ensure_type(event, 'has_max_reads', bool)
 
     # Don't need to do anything if not tracking max reads
     if not event['has_max_reads']:
         return
 
-    # Get copies's tags
+    # Increase reads, getting initial values from copy's tags if first read tracked
+    # NOTE Tracked in a state object rather than tags as tags can't be updated conditionally
+    # NOTE First tracked read costs an extra request (to get tags) but later ones don't, whereas
+    #   seeding state when uploading would cost a request for every copy, even those never read
     copy_key = f"messages/{user}/copies/{event['copy_id']}"
+    def modify(state):
+        if not state:
+            resp = S3.get_object_tagging(Bucket=MSGS_BUCKET, Key=copy_key)
+            tags = {d['Key']: d['Value'] for d in resp['TagSet']}
+            state = {'reads': int(tags['stello-reads']), 'max_reads': int(tags['stello-max-reads'])}
+            if 'stello-lifespan' in tags:
+                state['lifespan'] = tags['stello-lifespan']  # So state expires along with copy
+        state['reads'] += 1
+        return state
+    state_key = f"state/{user}/reads/{event['copy_id']}"
     try:
-        resp = S3.get_object_tagging(Bucket=MSGS_BUCKET, Key=copy_key)
+        state = _update_state(state_key, modify)
     except S3.exceptions.NoSuchKey:
         return  # If msg already deleted, no reason to do any further processing (still report resp)
-    tags = {d['Key']: d['Value'] for d in resp['TagSet']}
-
-    # Parse and increase reads
-    reads = int(tags['stello-reads'])
-    max_reads = int(tags['stello-max-reads'])
-    reads += 1
-    tags['stello-reads'] = str(reads)
-
-    # Either delete message or update reads
-    if reads >= max_reads:
-        S3.delete_object(Bucket=MSGS_BUCKET, Key=copy_key)
-        # Also delete invite image
-        S3.delete_object(Bucket=MSGS_BUCKET, Key=f"messages/{user}/invite_images/{event['copy_id']}")
-    else:
-        S3.put_object_tagging(
-            Bucket=MSGS_BUCKET,
-            Key=copy_key,
-            Tagging={
-                # WARN MUST preserve other tags (like stello-lifespan!)
-                'TagSet': [{'Key': k, 'Value': v} for k, v in tags.items()],
-            },
-        )
+    except StateConflict:
+        # NOTE Still store the read, as it matters more than the count (which just misses one)
+        _report_error({})
+        return
+
+    # Delete message and its invite image if reached max reads
+    # NOTE Read state deleted too, as a later read will find the copy gone and so not recreate it
+    if state['reads'] >= state['max_reads']:
+        resp = S3.delete_objects(Bucket=MSGS_BUCKET, Delete={'Quiet': True, 'Objects': [
+            {'Key': copy_key},
+            {'Key': f"messages/{user}/invite_images/{event['copy_id']}"},
+        ]})
+        if resp.get('Errors'):
+            raise Exception(f"Failed to delete {len(resp['Errors'])} objects of expired copy")
+        S3.delete_object(Bucket=RESP_BUCKET, Key=state_key)
 
 
 def handle_reply(user, config, event):
@@ -248,17 +692,10 @@ def handle_reaction(user, config, event):
     """Notify user of reactions to their messages"""
 
     # Shouldn't be getting reactions if disabled them
+    # NOTE Reaction's content already validated by schema
     if not config['allow_reactions']:
         raise Abort()
 
-    # Ensure reaction is a short single word if present (or null)
-    # SECURITY Prevents inserting long messages as a "reaction" but allows future codes too
-    #   Noting that user may have enabled notifications for reactions, putting their value in emails
-    if 'content' in event and event['content'] is not None:
-        _ensure_valid_chars(event, 'content', string.ascii_letters + string.digits + '-_')
-        if len(event['content']) > 25:
-            raise Exception("Reaction content too long")
-
 
 def handle_subscription(user, config, event):
     """Subscription modifications don't need any processing"""
@@ -305,6 +742,48 @@ class Abort(Exception):
     """Abort and respond with failure, but don't report any error"""
 
 
+class StateConflict(Exception):
+    """Too many concurrent changes to a state object to update it"""
+
+
+class RateLimited(Exception):
+    """Respond with 429 as client has made too many requests (not an error)"""
+
+
+class LocalRateLimiter:
+    """Token buckets kept in the memory of the warm container
+
+    May be replaced with any object with the same `allow()` method, such as a shared store
+
+    """
+
+    def __init__(self, max_keys=10000):
+        self._buckets = OrderedDict()  # key -> (tokens, last_updated)
+        self._max_keys = max_keys
+        self._lock = Lock()
+
+    def allow(self, key, rate, burst):
+        """Take a token from key's bucket, returning False if there are none left"""
+        now = monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            allowed = tokens >= 1
+            self._buckets[key] = (tokens - 1 if allowed else tokens, now)
+            if len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)  # Least recently used
+        return allowed
+
+
+RATE_LIMITER = LocalRateLimiter()
+
+
+def _rate_limit(kind, value):
+    """Raise RateLimited if too many requests for given kind of key (e.g. 'ip')"""
+    if not RATE_LIMITER.allow(f'{kind}:{value}', *RATE_LIMITS[kind]):
+        raise RateLimited()
+
+
 def _url64_to_bytes(url64_string):
     """Convert custom-url-base64 encoded string to bytes"""
     return base64.urlsafe_b64decode(url64_string.replace('~', '='))
@@ -315,33 +794,169 @@ def _bytes_to_url64(bytes_data):
     return base64.urlsafe_b64encode(bytes_data).decode().replace('=', '~')
 
 
+@lru_cache(maxsize=32)
+def _load_public_key(key_url64):
+    """Decode and load a public key (cached since only changes when user rotates it)"""
+    return load_der_public_key(_url64_to_bytes(key_url64))
+
+
+@lru_cache(maxsize=32)
+def _load_x25519_key(key_url64):
+    """Decode and load a raw X25519 public key (cached since only changes when user rotates it)"""
+    return X25519PublicKey.from_public_bytes(_url64_to_bytes(key_url64))
+
+
 def _get_config(user, secret):
-    """Download, decrypt and parse responder config"""
-    encrypted = S3.get_object(Bucket=RESP_BUCKET, Key=f'config/{user}/config')['Body'].read()
-    decryptor = AESGCM(_url64_to_bytes(secret))
-    decrypted = decryptor.decrypt(encrypted[:SYM_IV_BYTES], encrypted[SYM_IV_BYTES:], None)
-    return json.loads(decrypted)
+    """Download, decrypt and parse responder config (cached while container is warm)
 
+    SECURITY Cache is keyed by a hash of the secret so a cached config is only ever returned to
+        requests that could have decrypted it themselves
 
-def _ensure_type(event, key, type_):
-    """Ensure key's value is of given type"""
-    if not isinstance(event.get(key), type_):
-        raise Exception(f"Invalid or missing value for '{key}'")
+    """
+    cache_key = (user, hashlib.sha256(secret.encode()).hexdigest())
+    with _cache_lock:
+        cached = _config_cache.get(cache_key)
+        if cached:
+            _config_cache.move_to_end(cache_key)
+    get_args = {'Bucket': RESP_BUCKET, 'Key': f'config/{user}/config'}
+
+    if cached:
+        etag, config, checked = cached
+
+        # Use cached config without any request if checked recently
+        if time() - checked < CONFIG_CACHE_TTL:
+            CONFIG_CACHE_STATS['hit'] += 1
+            _metric_prop('config_cache', 'hit')
+            return deepcopy(config)  # WARN Copy since callers may modify config
+
+        # Otherwise only download again if config has changed
+        try:
+            with _timed('config_fetch'):
+                obj = S3.get_object(**get_args, IfNoneMatch=etag)
+        except ClientError as exc:
+            if exc.response['ResponseMetadata']['HTTPStatusCode'] != 304:
+                raise
+            CONFIG_CACHE_STATS['revalidated'] += 1
+            _metric_prop('config_cache', 'revalidated')
+            with _cache_lock:
+                _config_cache[cache_key] = (etag, config, time())
+            return deepcopy(config)
+    else:
+        with _timed('config_fetch'):
+            obj = S3.get_object(**get_args)
+
+    # Decrypt and parse fresh config
+    CONFIG_CACHE_STATS['miss'] += 1
+    _metric_prop('config_cache', 'miss')
+    with _timed('config_decrypt'):
+        encrypted = obj['Body'].read()
+        decryptor = AESGCM(_url64_to_bytes(secret))
+        decrypted = decryptor.decrypt(encrypted[:SYM_IV_BYTES], encrypted[SYM_IV_BYTES:], None)
+        config = json.loads(decrypted)
+
+    # Cache config, dropping least recently used if full
+    with _cache_lock:
+        _config_cache[cache_key] = (obj['ETag'], config, time())
+        _config_cache.move_to_end(cache_key)
+        while len(_config_cache) > CONFIG_CACHE_SIZE:
+            _config_cache.popitem(last=False)
+
+    return deepcopy(config)
 
 
-def _ensure_valid_chars(event, key, valid_chars):
-    """Ensure key's value is a string made of valid chars"""
-    _ensure_type(event, key, str)
-    if not event[key]:
-        raise Exception(f"Empty string for '{key}'")
-    for char in event[key]:
-        if char not in valid_chars:
-            raise Exception(f"Invalid character '{char}' in {key}")
+def _decode_body(api_event):
+    """Return request body as bytes, decompressing it if needed
+
+    SECURITY Decompression is bounded so a small body can't expand to use all available memory
+
+    """
+
+    # Decode body, rejecting if too large even before decompressing
+    body = api_event.get('body') or ''
+    if len(body) > MAX_BODY_BYTES * 4 / 3:  # Allow for base64 encoding
+        raise Exception("Request body too large")
+    body = base64.b64decode(body) if api_event.get('isBase64Encoded') else body.encode()
+
+    # Decompress if needed
+    encoding = api_event['headers'].get('content-encoding', 'identity').strip().lower()
+    if encoding in ('gzip', 'deflate'):
+        # NOTE wbits value auto-detects gzip or zlib headers
+        decompressor = zlib.decompressobj(wbits=32 + zlib.MAX_WBITS)
+        body = decompressor.decompress(body, MAX_BODY_BYTES + 1)
+        if len(body) > MAX_BODY_BYTES or decompressor.unconsumed_tail:
+            raise Exception("Decompressed request body too large")
+        if not decompressor.eof:
+            raise Exception("Compressed request body truncated")
+    elif encoding != 'identity':
+        raise Exception(f"Unsupported content encoding: {encoding}")
+
+    if len(body) > MAX_BODY_BYTES:
+        raise Exception("Request body too large")
+    return body
+
+
+def _deadline(context):
+    """Return time by which work must be done to respond before lambda times out (if known)"""
+    if not context:
+        return None
+    return time() + context.get_remaining_time_in_millis() / 1000 - DEADLINE_MARGIN
+
+
+def _wait(future, deadline):
+    """Return result of future, raising TimeoutError if not done by deadline"""
+    return future.result(timeout=None if deadline is None else max(0, deadline - time()))
+
+
+def _compile_schema(schema):
+    """Return function that raises if given data doesn't match the schema"""
+    fields = [(key, types, required, re.compile(pattern).fullmatch if pattern else None)
+        for key, (types, required, pattern) in schema.items()]
+
+    def validate(data):
+        if not isinstance(data, dict):
+            raise Exception("Data is not an object")
+        for key, types, required, match in fields:
+            if key not in data:
+                if required:
+                    raise Exception(f"Missing value for '{key}'")
+                continue
+            if not isinstance(data[key], types):
+                raise Exception(f"Invalid type for '{key}'")
+            if match and isinstance(data[key], str) and not match(data[key]):
+                raise Exception(f"Invalid value for '{key}'")
+
+    return validate
+
+
+EVENT_VALIDATORS = {
+    resp_type: _compile_schema({**EVENT_SCHEMAS['*'], **EVENT_SCHEMAS.get(resp_type, {})})
+    for resp_type in VALID_TYPES
+}
+BATCH_VALIDATOR = _compile_schema(BATCH_SCHEMA)
 
 
 def _report_error(api_event):
-    """Report error"""
-    print(format_exc())
+    """Report error in the background, deduping and rate limiting identical errors
+
+    NOTE Traceback is always logged immediately, so not lost even if deduped or limited
+    NOTE Count of unsent duplicates is included with the next report of the same error
+
+    """
+    trace = format_exc()
+    print(trace)
+
+    # Only send if haven't sent the same error recently and not reporting it too often
+    # NOTE Limit is kept per error (in case forgotten when deduping), so one can't hide others
+    fingerprint = hashlib.sha256(trace.encode()).hexdigest()
+    with _reports_lock:
+        last_sent, suppressed = _reports_seen.pop(fingerprint, (None, 0))
+        if (last_sent and monotonic() - last_sent < REPORT_DEDUPE_WINDOW) \
+                or not RATE_LIMITER.allow(f'report:{fingerprint}', *REPORT_LIMIT):
+            _reports_seen[fingerprint] = (last_sent, suppressed + 1)
+            return
+        _reports_seen[fingerprint] = (monotonic(), 0)
+        while len(_reports_seen) > REPORT_SEEN_MAX:
+            _reports_seen.popitem(last=False)
 
     # Add request metadata if available
     payload_data = {}
@@ -357,20 +972,79 @@ def _report_error(api_event):
     except:
         pass
 
-    # Send to Rollbar
-    rollbar.report_exc_info(payload_data=payload_data)
+    # Send to Rollbar in the background
+    extra_data = {'suppressed_duplicates': suppressed} if suppressed else None
+    future = REPORTER.submit(_send_report, sys.exc_info(), extra_data, payload_data)
+    with _reports_lock:
+        _reports_pending.append(future)
+
+
+def _send_report(exc_info, extra_data, payload_data):
+    """Send report to Rollbar (in reporter thread, so importing Rollbar doesn't delay requests)"""
+    _rollbar().report_exc_info(exc_info, extra_data=extra_data, payload_data=payload_data)
+
 
+def _flush_reports(deadline):
+    """Wait for pending error reports to be sent, giving up at deadline (if any)"""
+    with _reports_lock:
+        pending = list(_reports_pending)
+    if pending:
+        wait(pending, timeout=None if deadline is None else max(0, deadline - time()))
+    with _reports_lock:
+        _reports_pending[:] = [future for future in _reports_pending if not future.done()]
 
-def _put_resp(config, resp_type, event, ip, user):
+
+def _put_resp(config, resp_type, event, ip, user, stored=None):
     """Save response object with encrypted data
 
+    `stored` is an optional future to resolve once the object itself is stored, which is before
+    counts and manifests are updated
+
     SECURITY Ensure objects can't be placed in other dirs which app would never download
 
     """
+    try:
+        timestamp, object_id, object_path = _store_resp(config, resp_type, event, ip, user)
+    except BaseException as exc:
+        if stored:
+            stored.set_exception(exc)
+        raise
+    if stored:
+        stored.set_result(object_id)
+
+    # Keep count of stored responses up to date if will need for notifications
+    # NOTE Failures after storing are only reported, as response was still stored successfully
+    #   (and counts are rebuilt at least daily anyway)
+    # NOTE If not counting, any existing counts are deleted as would otherwise be trusted (but
+    #   wrong) if notify settings later change to need them (deleting is free unlike writing)
+    if resp_type in COUNTED_TYPES:
+        try:
+            with _timed('count'):
+                if _notify_needs_counts(config):
+                    _increment_resp_count(user, resp_type, object_id)
+                else:
+                    S3.delete_object(Bucket=RESP_BUCKET, Key=f'state/{user}/resp_counts')
+        except:
+            _report_error({})
+
+    # Add to manifest if enabled
+    if RESP_MANIFEST:
+        try:
+            with _timed('manifest'):
+                _add_to_manifest(user, resp_type, object_path, timestamp)
+        except:
+            _report_error({})
+
+
+def _store_resp(config, resp_type, event, ip, user):
+    """Encrypt and store response object, returning its timestamp, key and path within its type"""
 
     # Work out object id
     # Timestamp prefix for order, uuid suffix for uniqueness
-    object_id = f'responses/{user}/{resp_type}/{int(time())}_{uuid4()}'
+    timestamp = int(time())
+    object_name = f'{timestamp}_{uuid4()}'
+    object_path = _resp_partition_path(config, object_name)
+    object_id = f'responses/{user}/{resp_type}/{object_path}'
 
     # Encode data
     data = json.dumps({
@@ -378,46 +1052,265 @@ def _put_resp(config, resp_type, event, ip, user):
         'ip': ip,
     }).encode()
 
-    # Decode asym public key and setup asym encrypter
-    asym_key = _url64_to_bytes(config['resp_key_public'])
-    asym_encryter = load_der_public_key(asym_key)
+    # Encrypt data and produce output in format app supports
+    output = _encrypt_resp(config, data)
+
+    # Store in bucket
+    with _timed('put_resp_store'):
+        S3.put_object(Bucket=RESP_BUCKET, Key=object_id, Body=output)
+    return timestamp, object_id, object_path
+
+
+def _resp_partition_path(config, object_name):
+    """Return object's path within its type's prefix, placing it in a partition if enabled
+
+    If config has `resp_partitions` then objects are spread across that many sub-prefixes (by
+    hash of name), so that bursts of responses for a user don't exceed S3's per-prefix limits
+
+    """
+    partitions = min(int(config.get('resp_partitions') or 1), RESP_PARTITIONS_MAX)
+    if partitions <= 1:
+        return object_name
+    digest = hashlib.sha256(object_name.encode()).digest()
+    return f'{int.from_bytes(digest[:4], "big") % partitions:02x}/{object_name}'
+
+
+def _encrypt_resp(config, data):
+    """Encrypt response data with a new sym key that only the user's private key can recover
 
-    # Generate sym key and encrypted form of it
-    sym_key = AESGCM.generate_key(SYM_KEY_BITS)
-    encrypted_key = asym_encryter.encrypt(sym_key, OAEP(MGF1(SHA256()), SHA256(), None))
+    The sym key is either RSA encrypted (`encrypted_key`) or, if the user has an X25519 key,
+    derived from an exchange with an ephemeral key whose public part is stored (`ephemeral_key`)
 
-    # Encrypt data and produce output
-    sym_encrypter = AESGCM(sym_key)
+    """
+
+    # Generate sym key and the form of it to store (using user's public key)
+    if config.get('resp_key_x25519'):
+        with _timed('put_resp_x25519'):
+            sym_key, ephemeral_key = _encapsulate_x25519(config['resp_key_x25519'])
+        key_field, stored_key, flags = 'ephemeral_key', ephemeral_key, RESP_FLAG_X25519
+    else:
+        with _timed('put_resp_rsa'):
+            asym_encryter = _load_public_key(config['resp_key_public'])
+            sym_key = AESGCM.generate_key(SYM_KEY_BITS)
+            encrypted_key = asym_encryter.encrypt(sym_key, ASYM_PADDING)
+        key_field, stored_key, flags = 'encrypted_key', encrypted_key, 0
+
+    # Encrypt data
+    with _timed('put_resp_aes'):
+        if config.get('resp_format') == 'binary':
+            return _encrypt_resp_binary(data, sym_key, stored_key, flags)
+        sym_encrypter = AESGCM(sym_key)
+        iv = os.urandom(SYM_IV_BYTES)
+        encrypted_data = iv + sym_encrypter.encrypt(iv, data, None)
+        return json.dumps({
+            'encrypted_data': _bytes_to_url64(encrypted_data),
+            key_field: _bytes_to_url64(stored_key),
+        }).encode()
+
+
+def _encapsulate_x25519(key_url64):
+    """Return a new sym key for user's X25519 public key, and the ephemeral public key to store"""
+    user_key = _load_x25519_key(key_url64)
+    ephemeral = X25519PrivateKey.generate()
+    ephemeral_public = ephemeral.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    user_public = user_key.public_bytes(Encoding.Raw, PublicFormat.Raw)
+    sym_key = HKDF(SHA256(), SYM_KEY_BITS // 8, None, KEM_INFO_PREFIX + ephemeral_public
+        + user_public).derive(ephemeral.exchange(user_key))
+    return sym_key, ephemeral_public
+
+
+def _encrypt_resp_binary(data, sym_key, stored_key, flags=0):
+    """Encrypt response data in binary format, compressing it first if large enough to benefit"""
+    if len(data) >= RESP_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            data = compressed
+            flags |= RESP_FLAG_DEFLATE
     iv = os.urandom(SYM_IV_BYTES)
-    encrypted_data = iv + sym_encrypter.encrypt(iv, data, None)
-    output = json.dumps({
-        'encrypted_data': _bytes_to_url64(encrypted_data),
-        'encrypted_key': _bytes_to_url64(encrypted_key),
-    })
+    return b''.join((
+        bytes((RESP_BINARY_MAGIC, RESP_BINARY_VERSION, flags)),
+        len(stored_key).to_bytes(2, 'big'),
+        stored_key,
+        iv,
+        AESGCM(sym_key).encrypt(iv, data, None),
+    ))
 
-    # Store in bucket
-    S3.put_object(Bucket=RESP_BUCKET, Key=object_id, Body=output.encode())
+
+def _get_state(key):
+    """Return parsed JSON state object and its etag (both None if doesn't exist)"""
+    try:
+        obj = S3.get_object(Bucket=RESP_BUCKET, Key=key)
+    except S3.exceptions.NoSuchKey:
+        return None, None
+    return json.loads(obj['Body'].read()), obj['ETag']
 
 
-def _count_resp_objects(user, resp_type):
-    """Return a count of stored objects for the given response type
+def _put_state(key, state, etag):
+    """Write state object only if unchanged since read, returning whether successful
 
-    TODO Paginates at 1000, which may be a concern when counting reactions for popular users
+    NOTE State with a `lifespan` is tagged with it, so expires via the same rules as messages
 
     """
-    resp = S3.list_objects_v2(
-        Bucket=RESP_BUCKET,
-        Prefix=f'responses/{user}/{resp_type}/',
-    )
-    return resp['KeyCount']
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    if 'lifespan' in state:
+        condition['Tagging'] = f"stello-lifespan={state['lifespan']}"
+    try:
+        S3.put_object(Bucket=RESP_BUCKET, Key=key, Body=json.dumps(state).encode(), **condition)
+    except ClientError as exc:
+        # NOTE 412 if changed since read, 409 if another write happened at same time
+        #   and 404 if deleted since read
+        if exc.response['ResponseMetadata']['HTTPStatusCode'] in (404, 409, 412):
+            return False
+        raise
+    return True
+
+
+def _update_state(key, modify):
+    """Apply modify() to a state object and return new state, retrying if changed concurrently"""
+    for attempt in range(STATE_RETRIES):
+        if attempt:
+            # Random ("full jitter") exponential backoff so concurrent writers don't retry in step
+            sleep(random.uniform(0, min(STATE_BACKOFF[1], STATE_BACKOFF[0] * 2 ** attempt)))
+        state, etag = _get_state(key)
+        state = modify(state)
+        if _put_state(key, state, etag):
+            return state
+    raise StateConflict(key)
+
+
+def _list_resp_keys(user, resp_type):
+    """Yield keys of all stored objects for the given response type, in the order stored
+
+    Merges objects in any partitions with those stored before partitioning was enabled (if ever)
+    NOTE Partitions are discovered by listing, so still found if partition count later changes
+
+    """
+    legacy = []
+    partitions = []
+    paginator = S3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=RESP_BUCKET, Prefix=f'responses/{user}/{resp_type}/',
+            Delimiter='/'):
+        legacy.extend(obj['Key'] for obj in page.get('Contents', []))
+        partitions.extend(prefix['Prefix'] for prefix in page.get('CommonPrefixes', []))
+    if not partitions:
+        yield from legacy
+        return
+
+    # Names start with timestamp, so merging by name keeps keys in order stored
+    yield from heapq.merge(legacy, *(_list_keys(prefix) for prefix in partitions),
+        key=lambda key: key.rpartition('/')[2])
+
+
+def _list_keys(prefix):
+    """Yield keys of all objects with the given prefix"""
+    paginator = S3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=RESP_BUCKET, Prefix=prefix):
+        for obj in page.get('Contents', []):
+            yield obj['Key']
+
+
+def _count_resp_objects(user):
+    """Count stored objects for each counted response type, to rebuild a counts state object
+
+    `oldest` is any counted key, which when deleted indicates the app has downloaded responses
+
+    """
+    state = {'counts': {}, 'oldest': None, 'rebuilt': int(time())}
+    for resp_type in COUNTED_TYPES:
+        state['counts'][resp_type] = 0
+        for key in _list_resp_keys(user, resp_type):
+            state['counts'][resp_type] += 1
+            state['oldest'] = state['oldest'] or key
+    return state
+
+
+def _resp_counts_valid(state):
+    """Whether a counts state object still reflects what is stored"""
+    if not state or time() - state['rebuilt'] > RESP_COUNTS_MAX_AGE:
+        return False
+    if state['oldest']:
+        # The app deletes responses once downloaded, so counts are outdated if oldest is gone
+        try:
+            S3.head_object(Bucket=RESP_BUCKET, Key=state['oldest'])
+        except ClientError as exc:
+            if exc.response['ResponseMetadata']['HTTPStatusCode'] != 404:
+                raise
+            return False
+    return True
+
+
+def _increment_resp_count(user, resp_type, object_id):
+    """Increase stored count for the given response type (object must already be stored)"""
+    key = f'state/{user}/resp_counts'
 
+    def modify(state):
+        if not state:
+            return _count_resp_objects(user)  # Will include the new object
+        state['counts'][resp_type] += 1
+        state['oldest'] = state['oldest'] or object_id
+        return state
 
-def _send_notification(config, resp_type, event, user):
+    try:
+        _update_state(key, modify)
+    except StateConflict:
+        # Too much contention, so force a rebuild next time counts are needed
+        S3.put_object(Bucket=RESP_BUCKET, Key=key, Body=b'null')
+
+
+def _add_to_manifest(user, resp_type, object_path, timestamp):
+    """Add response to the manifest of responses stored during the same period
+
+    Manifests are at `state/{user}/manifest/{period_start}/{writer}` and are
+        {resp_type: [path, ...]}
+    So app can list manifests after a time and download only those to know what's new since
+    NOTE Paths are relative to the type's prefix, so include the partition if partitioned
+    NOTE Each container has its own manifest per period, so only its own threads can conflict
+
+    If `incomplete` is set in a manifest then some responses couldn't be added to it
+
+    """
+    key = f'state/{user}/manifest/{timestamp - timestamp % MANIFEST_PERIOD}/{MANIFEST_WRITER}'
+
+    def modify(manifest):
+        manifest = manifest or {}
+        manifest.setdefault(resp_type, []).append(object_path)
+        return manifest
+
+    try:
+        _update_state(key, modify)
+    except StateConflict:
+        # Too much contention, so mark the manifest as unreliable (keeping what it already lists)
+        _update_state(key, lambda manifest: {**(manifest or {}), 'incomplete': True})
+
+
+def _get_resp_counts(user):
+    """Return counts of stored objects for each counted response type"""
+    key = f'state/{user}/resp_counts'
+    state, etag = _get_state(key)
+    if not _resp_counts_valid(state):
+        state = _count_resp_objects(user)
+        # NOTE Fine if fails due to a concurrent update, as will just be rebuilt again next time
+        _put_state(key, state, etag)
+    return state['counts']
+
+
+def _notify_needs_counts(config):
+    """Whether notifications for the given config will include counts of stored responses"""
+    if config['notify_mode'] == 'none':
+        return False
+    return config['notify_mode'] == 'first_new_reply' or not config['notify_include_contents']
+
+
+def _send_notification(config, resp_type, event, user, stored=None, counted=None):
     """Notify user of replies/reactions/resends/subscribes for their messages (if configured to)
 
     Notify modes: none, first_new_reply, replies, replies_and_reactions
     Including contents only applies to: replies, replies_and_reactions
 
+    `stored` is the future for storing the response, if storing concurrently, and `counted` the
+    future for also updating counts etc. (only waited for when notification needs counts)
+    NOTE Not sent if storing fails, as recipient will retry and so would cause a duplicate
+
     """
 
     # Only notify for certain resp types
@@ -454,19 +1347,20 @@ def _send_notification(config, resp_type, event, user):
 
         # Prepare msg for body of notification
         msg = event['content']
-        if SELF_HOSTED:
-            msg += "\n" * 10
-            msg += (
-                "#### MESSAGE END ####\n"
-                "Open Stello to identify who responded and to reply to them"
-                " (not possible via email for security reasons)."
-                " Ignore storage provider's notes below."
-                " Instead, change notification settings in Stello."
-            )
+        footer = NOTIFY_FOOTER
+        includes_counts = False
     else:
+        # Counts must include this response, so wait till stored and counted
+        if stored and stored.exception():
+            return
+        if counted:
+            wait([counted])
+
         # Work out counts
-        reply_count = _count_resp_objects(user, 'reply') + _count_resp_objects(user, 'resend') + _count_resp_objects(user, 'subscribe')
-        reaction_count = _count_resp_objects(user, 'reaction')
+        with _timed('count'):
+            counts = _get_resp_counts(user)
+        reply_count = counts['reply'] + counts['resend'] + counts['subscribe']
+        reaction_count = counts['reaction']
 
         # If notify_mode is first_new_reply then only continue if this is the first
         # NOTE Already returned if a reaction and in this notify_mode
@@ -489,37 +1383,158 @@ def _send_notification(config, resp_type, event, user):
         heading = f"You have {summary} to your messages"
 
         # Work out msg
-        msg = ""
-        if SELF_HOSTED:
-            msg += "Open Stello to see them"
-            msg += "\n" * 10
-            msg += "Ignore storage provider's notes below. Instead, change notification settings in Stello."
+        msg = "Open Stello to see them" if SELF_HOSTED else ""
+        footer = "Ignore storage provider's notes below. Instead, change notification settings in Stello."
+        includes_counts = True
+
+    # Only notify once stored (contents prepared while storing, but still need to wait)
+    if stored and stored.exception():
+        return
+
+    # Send notification now or add to digest
+    if DIGEST_WINDOW:
+        _queue_notification(config, user, subject, heading, msg, footer, includes_counts)
+    else:
+        _deliver_notification(config.get('email'), user, subject, heading, msg, footer)
+
+
+def _deliver_notification(email, user, subject, heading, msg, footer):
+    """Send notification via SNS (self-hosted) or SES (hosted)
+
+    `footer` is only included for self-hosted, as SNS emails can't be customised like SES ones
+
+    """
 
     # In case multiple sending profiles, note the bucket name in the subject
     subject += f" [{MSGS_BUCKET if SELF_HOSTED else user}]"
 
     # Send notification
     if not DEV:
-        if SELF_HOSTED:
-            boto3.client('sns', config=AWS_CONFIG).publish(
-                TopicArn=TOPIC_ARN, Subject=subject, Message=f'{heading}\n\n\n{msg}')
-        else:
-            boto3.client('ses', config=AWS_CONFIG).send_email(
-                Source=f"Stello <no-reply@{DOMAIN_BRANDED}>",
-                Destination={'ToAddresses': [config['email']]},
-                Message={
-                    'Subject': {
-                        'Data': subject,
-                        'Charset': 'UTF-8',
-                    },
-                    'Body': {
-                        'Html': {
-                            'Data': generate_email(heading, msg),
+        with _timed('notify_send'):
+            if SELF_HOSTED:
+                _aws_client('sns').publish(
+                    TopicArn=TOPIC_ARN, Subject=subject,
+                    Message=f'{heading}\n\n\n{msg}' + "\n" * 10 + footer)
+            else:
+                # NOTE Template (with its large embedded image) only imported when first needed
+                from email_template import generate_email
+                _aws_client('ses').send_email(
+                    Source=f"Stello <no-reply@{DOMAIN_BRANDED}>",
+                    Destination={'ToAddresses': [email]},
+                    Message={
+                        'Subject': {
+                            'Data': subject,
                             'Charset': 'UTF-8',
                         },
+                        'Body': {
+                            'Html': {
+                                'Data': generate_email(heading, msg),
+                                'Charset': 'UTF-8',
+                            },
+                        },
                     },
-                },
-            )
+                )
+
+
+def _queue_notification(config, user, subject, heading, msg, footer, includes_counts):
+    """Add notification to user's pending digest, sending the digest early if it's large or old
+
+    Each notification is its own object, so concurrent ones never conflict (and none are lost)
+    Object names start with time queued, so listing them gives them oldest first
+
+    SECURITY Pending notifications contain the same content as would have been emailed
+        They are only stored until the digest is sent (and deleted with the user's account)
+
+    """
+    item = {'subject': subject, 'heading': heading, 'msg': msg, 'footer': footer,
+        'includes_counts': includes_counts,
+        'email': config.get('email')}  # Scheduled flush doesn't have access to config
+    S3.put_object(Bucket=RESP_BUCKET, Body=json.dumps(item).encode(),
+        Key=f'pending_notifications/{user}/items/{int(time() * 1000):013d}_{uuid4().hex}')
+
+    keys = list(_list_keys(f'pending_notifications/{user}/items/'))
+    # NOTE Own notification may already have been sent by a concurrent flush
+    if keys and (len(keys) >= DIGEST_MAX or time() - _pending_time(keys[0]) >= DIGEST_WINDOW * 10):
+        _flush_notifications(user)
+
+
+def _pending_time(key):
+    """Return time a pending notification was queued, from its key"""
+    return int(key.rpartition('/')[2].partition('_')[0]) / 1000
+
+
+def _flush_notifications(user):
+    """Send user's pending notifications as a single digest
+
+    A claim object ensures concurrent flushes don't send the same notifications twice
+    Notifications are only deleted once sent, so if sending fails they're sent next time instead
+
+    """
+    prefix = f'pending_notifications/{user}/'
+
+    # Claim user's notifications, taking over the claim if its flush must have failed
+    claim_key = prefix + 'claim'
+    claim, claim_etag = _get_state(claim_key)
+    if claim and time() - claim['claimed'] < DIGEST_FLUSH_TIMEOUT:
+        return  # Another flush in progress, which will send them
+    if not _put_state(claim_key, {'claimed': time()}, claim_etag):
+        return  # Another flush just claimed them
+    try:
+
+        # Get notifications, only keeping the latest of those that include counts
+        items = []
+        keys = list(_list_keys(prefix + 'items/'))
+        for key in keys:
+            try:
+                item = json.loads(S3.get_object(Bucket=RESP_BUCKET, Key=key)['Body'].read())
+            except S3.exceptions.NoSuchKey:
+                continue  # Already sent by a flush that was taken over
+            if item['includes_counts']:
+                items = [i for i in items if not i['includes_counts']]
+            items.append(item)
+        if not items:
+            return
+
+        # Combine into single notification
+        if len(items) == 1:
+            subject, heading, msg, footer = (items[0][k] for k in ('subject', 'heading', 'msg', 'footer'))
+        else:
+            subject = f"Stello: {len(items)} new notifications"
+            heading = "You have new responses to your messages"
+            msg = "\n\n\n".join(f"{i['heading']}\n\n{i['msg']}" for i in items)
+            footer = NOTIFY_FOOTER
+
+        # Send and then delete what was sent
+        _deliver_notification(items[-1]['email'], user, subject, heading, msg, footer)
+        resp = S3.delete_objects(Bucket=RESP_BUCKET, Delete={'Quiet': True,
+            'Objects': [{'Key': key} for key in keys]})
+        if resp.get('Errors'):
+            raise Exception(f"Failed to delete {len(resp['Errors'])} sent notifications")
+
+    finally:
+        S3.delete_object(Bucket=RESP_BUCKET, Key=claim_key)
+
+
+@_instrumented
+@_flushes_reports
+def flush_notifications(event, context):
+    """Entrypoint for scheduled sending of digests that haven't had new notifications recently"""
+    deadline = _deadline(context)
+    paginator = S3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=RESP_BUCKET, Prefix='pending_notifications/',
+            Delimiter='/'):
+        for common in page.get('CommonPrefixes', []):
+            # Leave remaining users for the next scheduled flush if running out of time
+            if deadline and time() > deadline - DEADLINE_MARGIN * 5:
+                return
+            user = common['Prefix'].split('/')[1]
+            try:
+                # Skip digests still receiving notifications
+                keys = list(_list_keys(f'pending_notifications/{user}/items/'))
+                if keys and time() - _pending_time(keys[-1]) >= DIGEST_WINDOW:
+                    _flush_notifications(user)
+            except:
+                _report_error({})
 
 
 # INVITER
@@ -537,26 +1552,130 @@ def inviter_image(api_event):
         img_format = "png" if params.get('f', 'jpeg') == "png" else "jpeg"
     except KeyError:
         raise Abort()  # Incorrect params given
+    _rate_limit('user', user)
+    _rate_limit('copy', f'{user}/{copy_id}')
 
-    # Retrieve and decrypt the image
+    # Retrieve the image, only downloading again if changed since cached
     bucket_key = f'messages/{user}/invite_images/{copy_id}'
+    cache_key = (bucket_key, hashlib.sha256(secret.encode()).hexdigest())
+    with _cache_lock:
+        cached = _inviter_cache.get(cache_key)
+        if cached:
+            _inviter_cache.move_to_end(cache_key)
+    condition = {'IfNoneMatch': cached[0]} if cached else {}
+    _metric_prop('type', 'inviter_image')
     try:
-        obj = S3.get_object(Bucket=MSGS_BUCKET, Key=bucket_key)
+        with _timed('inviter_fetch'):
+            obj = S3.get_object(Bucket=MSGS_BUCKET, Key=bucket_key, **condition)
+    except ClientError as exc:
+        if not cached or exc.response['ResponseMetadata']['HTTPStatusCode'] != 304:
+            return _inviter_response(api_event, img_format, EXPIRED_IMAGE, '"expired"',
+                EXPIRED_IMAGE_MAX_AGE)
+        _metric_prop('image_cache', 'hit')
+        s3_etag, body = cached
     except:
-        body = EXPIRED_IMAGE
+        return _inviter_response(api_event, img_format, EXPIRED_IMAGE, '"expired"',
+            EXPIRED_IMAGE_MAX_AGE)
     else:
-        encrypted = obj['Body'].read()
-        decryptor = AESGCM(_url64_to_bytes(secret))
-        decrypted = decryptor.decrypt(encrypted[:SYM_IV_BYTES], encrypted[SYM_IV_BYTES:], None)
-        body = base64.b64encode(decrypted).decode()
-
-    # Serve image
+        s3_etag = obj['ETag']
+        body = None
+
+    # Client may already have the image, in which case no need to decrypt it
+    # NOTE Etag includes the secret so that it can't be known without it
+    etag = '"' + hashlib.sha256((s3_etag + cache_key[1]).encode()).hexdigest()[:32] + '"'
+    if body is None and _inviter_not_modified(api_event, etag):
+        obj['Body'].close()  # Not needed, and would otherwise hold its connection till collected
+    elif body is None:
+        _metric_prop('image_cache', 'miss')
+        with _timed('inviter_decrypt'):
+            encrypted = obj['Body'].read()
+            decryptor = AESGCM(_url64_to_bytes(secret))
+            decrypted = decryptor.decrypt(encrypted[:SYM_IV_BYTES], encrypted[SYM_IV_BYTES:], None)
+            body = base64.b64encode(decrypted).decode()
+
+        # Cache encoded image, dropping least recently used if exceeding size limit
+        with _cache_lock:
+            _inviter_cache[cache_key] = (s3_etag, body)
+            while sum(len(b) for _, b in _inviter_cache.values()) > INVITER_CACHE_BYTES:
+                _inviter_cache.popitem(last=False)
+
+    return _inviter_response(api_event, img_format, body, etag, INVITER_MAX_AGE)
+
+
+def _inviter_not_modified(api_event, etag):
+    """Whether client's conditional request already has the version with the given etag"""
+    header = (api_event.get('headers') or {}).get('if-none-match', '')
+    return etag in [tag.strip() for tag in header.split(',')]
+
+
+def _inviter_response(api_event, img_format, body, etag, max_age):
+    """Serve image, or just confirm the client's copy is still valid if it has it already"""
+    headers = {
+        'content-type': f'image/{img_format}',
+        'cache-control': f'max-age={max_age}' if max_age else 'no-store',
+        'etag': etag,
+    }
+    if _inviter_not_modified(api_event, etag):
+        return {'statusCode': 304, 'headers': headers}
     return {
         'statusCode': 200,
-        'headers': {
-            'content-type': f'image/{img_format}',
-            'cache-control': 'no-store',
-        },
+        'headers': headers,
         'isBase64Encoded': True,
         'body': body,
     }
+
+
+# WARM-UP
+
+
+def warm_up(event):
+    """Prepare container so the first requests it handles are as fast as later ones
+
+    Event may optionally be: {
+        'user': string,  # Only needed if hosted
+        'config_secret': string,  # To also cache user's config
+        'connections': number,  # Connections to open to each bucket (default 1)
+    }
+
+    NOTE Only warms a single container, so invoke concurrently to warm more
+    NOTE Nothing is stored, so can be invoked as often as desired
+
+    """
+    _metric_prop('type', 'warmup')
+    try:
+        # Create clients and load modules that would otherwise only be loaded when first needed
+        _aws_client('sns' if SELF_HOSTED else 'ses')
+        if not SELF_HOSTED:
+            import email_template  # NOTE Large due to embedded image
+        _rollbar()
+
+        # Load crypto backends
+        sym_key = AESGCM.generate_key(SYM_KEY_BITS)
+        AESGCM(sym_key).encrypt(os.urandom(SYM_IV_BYTES), sym_key, None)
+        X25519PrivateKey.generate()
+
+        # Open connections to buckets (in parallel, which also starts the executor's threads)
+        # NOTE Objects needn't exist, as requests still connect even if they fail
+        def connect(bucket):
+            with suppress(ClientError):
+                S3.head_object(Bucket=bucket, Key='warmup')
+        connections = min(int(event.get('connections', 1)), AWS_CONFIG.max_pool_connections)
+        list(EXECUTOR.map(connect, [MSGS_BUCKET, RESP_BUCKET] * connections))
+
+        # Cache user's config and their public key if secret given
+        if event.get('config_secret'):
+            user = '_user' if SELF_HOSTED else event['user']
+            config = _get_config(user, event['config_secret'])
+            if config.get('resp_key_x25519'):
+                _load_x25519_key(config['resp_key_x25519'])
+            else:
+                _load_public_key(config['resp_key_public']).encrypt(sym_key, ASYM_PADDING)
+    except:
+        _report_error({})
+        return {'statusCode': 500}
+    return {'statusCode': 200}
+
+
+# Warm up during init if container is provisioned in advance (so not for a request)
+if os.environ.get('AWS_LAMBDA_INITIALIZATION_TYPE') == 'provisioned-concurrency':
+    warm_up({})
@@ -0,0 +1,212 @@
+"""Run the responder as a long-running HTTP server rather than as a lambda (for self-hosting)
+
+Requests are adapted into the same event format as API Gateway gives the lambda, so are processed
+by exactly the same logic. Uses the same env vars as the lambda, plus optionally:
+    stello_s3_endpoint: URL of an S3-compatible service to use instead of AWS
+    stello_allowed_origin: Origin the displayer is served from, if not the default S3 one
+
+Usage: python3 server.py [--host 127.0.0.1] [--port 8004] [--workers 16] [--queue 64]
+    [--behind-proxy]
+
+If behind a reverse proxy, use --behind-proxy so the client's IP is taken from X-Forwarded-For
+(otherwise all requests appear to come from the proxy and so share the same IP rate limit)
+SECURITY Only use if the proxy sets X-Forwarded-For, as otherwise clients could fake their IP
+
+WARN Metrics and logged AWS call counts are per process, so overlap if requests are concurrent
+
+"""
+
+import base64
+import signal
+import argparse
+from time import monotonic
+from threading import Thread, Event, Lock
+from urllib.parse import urlsplit, parse_qsl
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from concurrent.futures import ThreadPoolExecutor
+
+import responder
+
+
+REQUEST_TIMEOUT = 10  # Seconds, same as the lambda's timeout
+IDLE_TIMEOUT = 5  # Seconds to keep an idle connection open (as each occupies a worker)
+
+
+class LambdaContext:
+    """Stand-in for lambda's context, giving each request the same time limit as in lambda"""
+
+    def __init__(self):
+        self._deadline = monotonic() + REQUEST_TIMEOUT
+
+    def get_remaining_time_in_millis(self):
+        return max(0, int((self._deadline - monotonic()) * 1000))
+
+
+class ResponderHandler(BaseHTTPRequestHandler):
+    """Adapt HTTP requests to API Gateway events and respond with the result"""
+
+    protocol_version = 'HTTP/1.1'  # Keep connections alive so proxies can reuse them
+    disable_nagle_algorithm = True  # Otherwise small responses can be delayed on kept-alive conns
+    timeout = IDLE_TIMEOUT
+
+    def do_GET(self):
+        self._handle()
+
+    do_POST = do_GET
+    do_OPTIONS = do_GET
+
+    def _handle(self):
+        url = urlsplit(self.path)
+
+        # Reject large bodies before reading them (same as API Gateway would)
+        length = int(self.headers.get('content-length') or 0)
+        if length > responder.MAX_BODY_BYTES:
+            self.close_connection = True
+            self._respond({'statusCode': 413})
+            return
+        body = self.rfile.read(length)
+
+        # Client's IP is the last one added, as earlier ones may have been added by the client
+        source_ip = self.client_address[0]
+        if self.server.behind_proxy and self.headers.get('x-forwarded-for'):
+            source_ip = self.headers['x-forwarded-for'].split(',')[-1].strip()
+
+        # NOTE Header names lowercased and query params given only if any, like API Gateway does
+        api_event = {
+            'requestContext': {
+                'http': {
+                    'method': self.command,
+                    'path': url.path,
+                    'sourceIp': source_ip,
+                    'userAgent': self.headers.get('user-agent', ''),
+                },
+            },
+            'headers': {key.lower(): value for key, value in self.headers.items()},
+            'queryStringParameters': dict(parse_qsl(url.query)) or None,
+            'body': base64.b64encode(body).decode(),
+            'isBase64Encoded': True,
+        }
+
+        try:
+            response = responder.entry(api_event, LambdaContext())
+        except:
+            # Errors outside of entry's own handling (e.g. missing origin) are 500s in lambda too
+            response = {'statusCode': 500}
+
+        # Don't keep connection (and so this worker) idle while other connections are waiting
+        if self.server.busy():
+            self.close_connection = True
+        self._respond(response)
+
+    def _respond(self, response):
+        body = response.get('body') or ''
+        body = base64.b64decode(body) if response.get('isBase64Encoded') else body.encode()
+        self.send_response(response['statusCode'])
+        for key, value in response.get('headers', {}).items():
+            self.send_header(key, value)
+        self.send_header('content-length', str(len(body)))
+        if self.close_connection:
+            self.send_header('connection', 'close')  # So client doesn't try to reuse it
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class PooledHTTPServer(HTTPServer):
+    """HTTP server that handles connections with a bounded pool of threads and bounded queue
+
+    Connections beyond what the workers and queue can hold are rejected with a 503 (rather than
+    queued without limit), so a burst can't exhaust memory or leave clients waiting indefinitely
+
+    """
+
+    def __init__(self, address, handler, workers, queue=64, behind_proxy=False):
+        super().__init__(address, handler)
+        self.pool = ThreadPoolExecutor(max_workers=workers)
+        self.workers = workers
+        self.queue = queue
+        self.behind_proxy = behind_proxy
+        self._connections = 0  # Both queued and being handled
+        self._connections_lock = Lock()
+
+    def busy(self):
+        """Whether any connections are queued waiting for a worker"""
+        return self._connections > self.workers
+
+    def process_request(self, request, client_address):
+        with self._connections_lock:
+            full = self._connections >= self.workers + self.queue
+            if not full:
+                self._connections += 1
+        if full:
+            self._reject(request)
+            return
+        self.pool.submit(self._process_request, request, client_address)
+
+    def _process_request(self, request, client_address):
+        try:
+            self.finish_request(request, client_address)
+        except:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            with self._connections_lock:
+                self._connections -= 1
+
+    def _reject(self, request):
+        """Respond that server is unavailable without reading the request, then close"""
+        try:
+            request.sendall(b'HTTP/1.1 503 Service Unavailable\r\nretry-after: 1\r\n'
+                b'content-length: 0\r\nconnection: close\r\n\r\n')
+        except OSError:
+            pass  # Client already gone
+        self.shutdown_request(request)
+
+    def server_close(self):
+        """Stop listening and then wait for requests in progress to finish"""
+        super().server_close()
+        self.pool.shutdown(wait=True)
+
+
+def flush_periodically(stopped):
+    """Send notification digests that are due, as there's no scheduler when self-hosting"""
+    while not stopped.wait(responder.DIGEST_WINDOW):
+        try:
+            responder.flush_notifications({}, None)
+        except:
+            responder._report_error({})  # Keep trying, as listing may just have failed this once
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Stello responder as an HTTP server")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8004)
+    parser.add_argument('--workers', type=int, default=16)
+    parser.add_argument('--queue', type=int, default=64)
+    parser.add_argument('--behind-proxy', action='store_true')
+    args = parser.parse_args()
+
+    server = PooledHTTPServer((args.host, args.port), ResponderHandler, args.workers, args.queue,
+        args.behind_proxy)
+    stopped = Event()
+    if responder.DIGEST_WINDOW:
+        Thread(target=flush_periodically, args=(stopped,), daemon=True).start()
+
+    # Stop accepting connections on SIGTERM/SIGINT
+    # NOTE shutdown() blocks until serve_forever() returns, so must be called from another thread
+    def stop(signum, frame):
+        stopped.set()
+        Thread(target=server.shutdown).start()
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    print(f"Listening on {args.host}:{args.port}")
+    server.serve_forever()
+
+    # Finish requests in progress, including any storing/notifying they're still waiting on
+    server.server_close()
+    responder.EXECUTOR.shutdown(wait=True)
+    responder.REPORTER.shutdown(wait=True)  # Send any error reports still pending
+
+
+if __name__ == '__main__':
+    main()
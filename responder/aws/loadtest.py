@@ -0,0 +1,267 @@
+"""Replay a burst of recipient traffic against multiple responder processes and report on it
+
+Simulates what follows sending a message to many recipients: each opens it (fetching its invite
+image one or more times and reporting the read) and some reply or react. Requests are shuffled
+so recipients overlap, then processed as fast as possible by the simulated containers.
+
+Each container is a separate `function/server.py` process with a single worker, so like a warm
+lambda it handles one request at a time while keeping its own caches. AWS is replaced by the
+in-memory stand-in from `aws_stand_in.py`, which adds the given latency to every call (and error
+reports are counted by its Rollbar stand-in rather than sent).
+
+Usage: python3 loadtest.py [--containers 4] [--recipients 5000] [--s3-latency 20] ...
+    (see --help for all options, and any stello_* env vars set are passed to the responder)
+
+NOTE Requires the responder's requirements to be installed, but no AWS credentials
+
+"""
+
+import os
+import sys
+import json
+import random
+import socket
+import argparse
+import subprocess
+from time import sleep, perf_counter
+from queue import Queue, Empty
+from pathlib import Path
+from threading import Thread, Lock
+from collections import Counter, defaultdict
+from http.client import HTTPConnection
+from urllib.parse import urlencode
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from aws_stand_in import AwsStandIn, url64, encrypt
+
+
+SERVER_PATH = Path(__file__).parent / 'function' / 'server.py'
+MSGS_BUCKET = 'loadtest'
+RESP_BUCKET = MSGS_BUCKET + '-stello-resp'
+DOMAIN = 'loadtest.example'
+PERCENTILES = (50, 95, 99)
+
+
+# SETUP
+
+
+def seed(aws, user, args):
+    """Store the config, copies and invite images that recipients' requests rely on"""
+    config_secret = AESGCM.generate_key(256)
+    image_secret = AESGCM.generate_key(256)
+    config = {
+        'allow_replies': True,
+        'allow_reactions': True,
+        'allow_resend_requests': True,
+        'notify_mode': args.notify_mode,
+        'notify_include_contents': args.notify_mode != 'first_new_reply',
+        'email': 'loadtest@example.com',
+        'resp_partitions': args.partitions,
+    }
+    if args.x25519:
+        public = X25519PrivateKey.generate().public_key()
+        config['resp_key_x25519'] = url64(public.public_bytes(Encoding.Raw, PublicFormat.Raw))
+    else:
+        public = rsa.generate_private_key(65537, 4096).public_key()
+        config['resp_key_public'] = url64(public.public_bytes(Encoding.DER,
+            PublicFormat.SubjectPublicKeyInfo))
+    aws.put(RESP_BUCKET, f'config/{user}/config', encrypt(config_secret,
+        json.dumps(config).encode()))
+
+    image = encrypt(image_secret, os.urandom(args.image_bytes))
+    copy_ids = [url64(os.urandom(16)) for _ in range(args.recipients)]
+    for copy_id in copy_ids:
+        aws.put(MSGS_BUCKET, f'messages/{user}/copies/{copy_id}', os.urandom(2048),
+            {'stello-reads': '0', 'stello-max-reads': str(args.max_reads)})
+        aws.put(MSGS_BUCKET, f'messages/{user}/invite_images/{copy_id}', image)
+    return url64(config_secret), url64(image_secret), copy_ids
+
+
+def generate_requests(user, config_secret, image_secret, copy_ids, args):
+    """Return (endpoint, method, path, headers, body) for every request recipients will make"""
+    requests = []
+    for index, copy_id in enumerate(copy_ids):
+        ip = f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}'
+        headers = {'x-forwarded-for': ip}
+        image_path = '/inviter/image?' + urlencode({'user': user, 'copy': copy_id,
+            'k': image_secret})
+        for _ in range(random.randint(1, args.image_fetches)):
+            requests.append(('inviter_image', 'GET', image_path, headers, None))
+
+        def event(resp_type, **fields):
+            body = json.dumps({'config_secret': config_secret, 'encrypted': url64(os.urandom(96)),
+                'copy_id': copy_id, **fields})
+            return (resp_type, 'POST', f'/responder/{resp_type}',
+                {**headers, 'origin': args.origin, 'content-type': 'application/json'}, body)
+        requests.append(event('read', has_max_reads=bool(args.max_reads)))
+        if random.random() < args.reply_rate:
+            requests.append(event('reply', content="Thanks for the update! " * 5))
+        if random.random() < args.reaction_rate:
+            requests.append(event('reaction', content=random.choice(['like', 'love', 'laugh'])))
+
+    random.shuffle(requests)
+    return requests
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_containers(count, env):
+    """Start responder processes and return their ports once they accept connections"""
+    processes, ports = [], []
+    for _ in range(count):
+        ports.append(free_port())
+        processes.append(subprocess.Popen([sys.executable, str(SERVER_PATH), '--port',
+            str(ports[-1]), '--workers', '1', '--behind-proxy'], env=env,
+            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL))
+    for process, port in zip(processes, ports):
+        for _ in range(300):
+            if process.poll() is not None:
+                raise Exception("Responder process failed to start")
+            try:
+                socket.create_connection(('127.0.0.1', port)).close()
+                break
+            except ConnectionRefusedError:
+                sleep(0.1)
+    return processes, ports
+
+
+# RUN & REPORT
+
+
+def drive(port, queue, results, results_lock):
+    """Send requests from queue to a container, one at a time like lambda"""
+    conn = HTTPConnection('127.0.0.1', port, timeout=30)
+    while True:
+        try:
+            endpoint, method, path, headers, body = queue.get_nowait()
+        except Empty:
+            return
+        start = perf_counter()
+        try:
+            conn.request(method, path, body, headers)
+            resp = conn.getresponse()
+            resp.read()
+            status = resp.status
+        except Exception:
+            conn.close()  # Reconnects on next request
+            status = 'error'
+        with results_lock:
+            results[endpoint].append((status, (perf_counter() - start) * 1000))
+
+
+def percentile(sorted_values, p):
+    return sorted_values[min(len(sorted_values) - 1, round(p / 100 * (len(sorted_values) - 1)))]
+
+
+def report(results, calls, elapsed):
+    total = sum(len(r) for r in results.values())
+    print(f"\n{total} requests in {elapsed:.1f}s ({total / elapsed:.1f} req/s)\n")
+
+    print(f"{'endpoint':<15}{'requests':>9}{'req/s':>8}  {'statuses':<28}"
+        + ''.join(f"{'p' + str(p):>8}" for p in PERCENTILES) + "  (ms)")
+    for endpoint, items in sorted(results.items()):
+        latencies = sorted(ms for _, ms in items)
+        statuses = ' '.join(f'{s}:{n}' for s, n in sorted(Counter(s for s, _ in items).items(),
+            key=str))
+        print(f"{endpoint:<15}{len(items):>9}{len(items) / elapsed:>8.1f}  {statuses:<28}"
+            + ''.join(f"{percentile(latencies, p):>8.1f}" for p in PERCENTILES))
+
+    print(f"\n{'AWS calls':<45}{'total':>8}{'per s':>8}")
+    for call, count in sorted(calls.items()):
+        print(f"{call:<45}{count:>8}{count / elapsed:>8.1f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the responder with a burst of"
+        " recipient traffic")
+    parser.add_argument('--containers', type=int, default=4, help="Simulated warm containers")
+    parser.add_argument('--recipients', type=int, default=5000)
+    parser.add_argument('--image-fetches', type=int, default=3,
+        help="Max times each recipient fetches their invite image")
+    parser.add_argument('--reply-rate', type=float, default=0.05)
+    parser.add_argument('--reaction-rate', type=float, default=0.2)
+    parser.add_argument('--max-reads', type=int, default=10, help="0 to not track reads")
+    parser.add_argument('--image-bytes', type=int, default=30 * 1024)
+    parser.add_argument('--notify-mode', default='replies_and_reactions',
+        choices=['none', 'first_new_reply', 'replies', 'replies_and_reactions'])
+    parser.add_argument('--partitions', type=int, default=0, help="Partitions for responses")
+    parser.add_argument('--x25519', action='store_true', help="Use X25519 rather than RSA")
+    parser.add_argument('--hosted', action='store_true', help="Hosted rather than self-hosted")
+    parser.add_argument('--s3-latency', type=float, default=20, help="Avg ms per S3 call")
+    parser.add_argument('--notify-latency', type=float, default=50, help="Avg ms per email")
+    parser.add_argument('--seed', type=int, default=0, help="Seed for random traffic mix")
+    args = parser.parse_args()
+    random.seed(args.seed)
+
+    # Start AWS stand-in
+    aws = AwsStandIn(args.s3_latency, args.notify_latency).start()
+    endpoint = aws.endpoint
+
+    # Responder env (any stello_* vars already set take precedence, e.g. to enable features)
+    # NOTE Not development env as that disables notifications
+    env = {
+        'stello_env': 'loadtest',
+        'stello_version': 'loadtest',
+        'stello_msgs_bucket': MSGS_BUCKET,
+        'stello_region': 'us-west-2',
+        'stello_rollbar_responder': 'loadtest',
+        **os.environ,
+        'stello_rollbar_endpoint': endpoint + '/rollbar/',
+        'stello_s3_endpoint': endpoint,
+        'AWS_ENDPOINT_URL_SES': endpoint,
+        'AWS_ENDPOINT_URL_SNS': endpoint,
+        'AWS_ACCESS_KEY_ID': 'loadtest',
+        'AWS_SECRET_ACCESS_KEY': 'loadtest',
+    }
+    if args.hosted:
+        user = 'loadtest'
+        env['stello_domain_branded'] = DOMAIN
+        env['stello_domain_unbranded'] = 'unbranded.' + DOMAIN
+        args.origin = f'https://{user}.{DOMAIN}'
+    else:
+        user = '_user'
+        env.pop('stello_domain_branded', None)
+        env['stello_topic_arn'] = 'arn:aws:sns:us-west-2:000000000000:loadtest'
+        env['stello_allowed_origin'] = args.origin = 'https://loadtest.example'
+
+    print("Seeding data...")
+    config_secret, image_secret, copy_ids = seed(aws, user, args)
+    requests = generate_requests(user, config_secret, image_secret, copy_ids, args)
+    queue = Queue()
+    for request in requests:
+        queue.put(request)
+
+    print(f"Starting {args.containers} containers...")
+    processes, ports = start_containers(args.containers, env)
+    aws.calls.clear()  # Only count calls made while processing requests
+    try:
+        print(f"Sending {len(requests)} requests...")
+        results = defaultdict(list)
+        results_lock = Lock()
+        threads = [Thread(target=drive, args=(port, queue, results, results_lock))
+            for port in ports]
+        start = perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = perf_counter() - start
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    report(results, aws.calls, elapsed)
+
+
+if __name__ == '__main__':
+    main()
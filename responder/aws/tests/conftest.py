@@ -0,0 +1,148 @@
+"""Run the responder unmodified against the in-memory AWS stand-in (no network or credentials)"""
+
+import os
+import sys
+import json
+from pathlib import Path
+from functools import lru_cache
+
+import pytest
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+
+AWS_DIR = Path(__file__).parent.parent
+sys.path[:0] = [str(AWS_DIR), str(AWS_DIR / 'function')]
+from aws_stand_in import AwsStandIn, url64, encrypt
+
+
+# Responder reads its env when imported, so stand-in must be running and env set before then
+AWS = AwsStandIn().start()
+ORIGIN = 'https://stello.test'
+MSGS_BUCKET = 'test'
+RESP_BUCKET = MSGS_BUCKET + '-stello-resp'
+USER = '_user'  # Self-hosted
+os.environ.update({
+    'stello_env': 'test',
+    'stello_version': 'test',
+    'stello_msgs_bucket': MSGS_BUCKET,
+    'stello_region': 'us-west-2',
+    'stello_rollbar_responder': 'test',
+    'stello_rollbar_endpoint': AWS.endpoint + '/rollbar/',
+    'stello_topic_arn': 'arn:aws:sns:us-west-2:000000000000:test',
+    'stello_allowed_origin': ORIGIN,
+    'stello_s3_endpoint': AWS.endpoint,
+    'stello_metrics': '1',  # So timings of each stage are available
+    'AWS_ENDPOINT_URL_SES': AWS.endpoint,
+    'AWS_ENDPOINT_URL_SNS': AWS.endpoint,
+    'AWS_ACCESS_KEY_ID': 'test',
+    'AWS_SECRET_ACCESS_KEY': 'test',
+    'AWS_LAMBDA_FUNCTION_NAME': 'test',  # Behave as in lambda rather than as a server
+})
+os.environ.pop('stello_domain_branded', None)
+import responder
+
+
+@lru_cache()
+def resp_key():
+    """RSA key for encrypting responses (generated once as slow)"""
+    return rsa.generate_private_key(65537, 2048)
+
+
+class LambdaContext:
+    """Stand-in for lambda's context with plenty of time remaining"""
+
+    def __init__(self, remaining_ms=10000):
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+class Stello:
+    """A seeded user whose recipients can make requests"""
+
+    def __init__(self, aws, **config):
+        self.aws = aws
+        self.config_secret = AESGCM.generate_key(256)
+        self.image_secret = AESGCM.generate_key(256)
+        self.config = {
+            'resp_key_public': url64(resp_key().public_key().public_bytes(Encoding.DER,
+                PublicFormat.SubjectPublicKeyInfo)),
+            'allow_replies': True,
+            'allow_reactions': True,
+            'allow_resend_requests': True,
+            'notify_mode': 'replies_and_reactions',
+            'notify_include_contents': True,
+            'email': 'user@stello.test',
+            'subscribe_forms': ['form1'],
+            **config,
+        }
+        aws.put(RESP_BUCKET, f'config/{USER}/config', encrypt(self.config_secret,
+            json.dumps(self.config).encode()))
+
+    def add_copy(self, copy_id='copy1', reads=0, max_reads=10):
+        self.aws.put(MSGS_BUCKET, f'messages/{USER}/copies/{copy_id}', b'copy',
+            {'stello-reads': str(reads), 'stello-max-reads': str(max_reads)})
+        self.aws.put(MSGS_BUCKET, f'messages/{USER}/invite_images/{copy_id}',
+            encrypt(self.image_secret, b'image' * 1000))
+        return copy_id
+
+    def event(self, resp_type, ip='203.0.113.1', **fields):
+        """Return API Gateway event for a POST from a recipient"""
+        body = {'config_secret': url64(self.config_secret), 'encrypted': 'x' * 100, **fields}
+        return {
+            'requestContext': {'http': {'method': 'POST', 'path': f'/responder/{resp_type}',
+                'sourceIp': ip, 'userAgent': 'test'}},
+            'headers': {'origin': ORIGIN, 'content-type': 'application/json'},
+            'body': json.dumps(body),
+            'isBase64Encoded': False,
+        }
+
+    def image_event(self, copy_id, ip='203.0.113.1', headers=None):
+        """Return API Gateway event for fetching an invite image"""
+        return {
+            'requestContext': {'http': {'method': 'GET', 'path': '/inviter/image',
+                'sourceIp': ip, 'userAgent': 'test'}},
+            'headers': headers or {},
+            'queryStringParameters': {'user': USER, 'copy': copy_id,
+                'k': url64(self.image_secret)},
+        }
+
+    def decrypt_resp(self, key):
+        """Return the stored response data for the given key"""
+        stored = json.loads(self.aws.objects[(RESP_BUCKET, key)]['body'])
+        sym_key = resp_key().decrypt(responder._url64_to_bytes(stored['encrypted_key']),
+            responder.ASYM_PADDING)
+        encrypted = responder._url64_to_bytes(stored['encrypted_data'])
+        return json.loads(AESGCM(sym_key).decrypt(encrypted[:12], encrypted[12:], None))
+
+    def keys(self, prefix):
+        return sorted(k for b, k in self.aws.objects if b == RESP_BUCKET and k.startswith(prefix))
+
+
+def aws_calls(aws):
+    """Return total calls made to AWS (excluding error reports, which aren't sent to AWS)"""
+    return sum(count for call, count in aws.calls.items() if not call.startswith('Rollbar'))
+
+
+@pytest.fixture
+def aws():
+    """The AWS stand-in, emptied and with the responder's warm state cleared"""
+    responder._flush_reports(None)  # So reports from earlier tests aren't counted
+    with AWS.lock:
+        AWS.objects.clear()
+        AWS.calls.clear()
+        AWS.notifications.clear()
+    AWS.s3_latency = AWS.notify_latency = AWS.report_latency = 0
+    responder._config_cache.clear()
+    responder._inviter_cache.clear()
+    responder._reports_seen.clear()
+    responder.RATE_LIMITER._buckets.clear()
+    return AWS
+
+
+@pytest.fixture
+def stello(aws):
+    return Stello(aws)
@@ -0,0 +1,128 @@
+"""Regression tests for the AWS calls and time taken by each kind of request
+
+Fails if a change adds a round trip to any endpoint, or makes one much slower
+Results are also written as JSON to the path in `stello_perf_results` (if set)
+
+"""
+
+import os
+import json
+from time import perf_counter
+
+import pytest
+
+import responder
+from conftest import LambdaContext
+
+
+# Exact AWS calls expected for a request (with cold caches) as {'Operation prefix': count}
+# NOTE Config is fetched once as caches are cold, notify settings are to include contents
+EXPECTED_CALLS = {
+    'read': {
+        'GetObject config': 1,
+        'GetObject state/reads': 1,
+        'GetObjectTagging messages/copies': 1,
+        'PutObject state/reads': 1,
+        'PutObject responses/read': 1,
+    },
+    'reply': {
+        'GetObject config': 1,
+        'PutObject responses/reply': 1,
+        'DeleteObject state': 1,  # Counts not kept as notifying with contents
+        'Publish (notify)': 1,
+    },
+    'reaction': {
+        'GetObject config': 1,
+        'PutObject responses/reaction': 1,
+        'DeleteObject state': 1,  # Counts not kept as notifying with contents
+        'Publish (notify)': 1,
+    },
+    'subscription': {
+        'GetObject config': 1,
+        'PutObject responses/subscription': 1,
+    },
+    'address': {
+        'GetObject config': 1,
+        'PutObject responses/address': 1,
+    },
+    'resend': {
+        'GetObject config': 1,
+        'PutObject responses/resend': 1,
+        'DeleteObject state': 1,  # Counts not kept as notifying with contents
+        'Publish (notify)': 1,
+    },
+    'subscribe': {
+        'GetObject config': 1,
+        'PutObject responses/subscribe': 1,
+        'DeleteObject state': 1,  # Counts not kept as notifying with contents
+        'Publish (notify)': 1,
+    },
+    'inviter_image': {
+        'GetObject messages/invite_images': 1,
+    },
+}
+
+# Generous limits that only catch large regressions, as CI machines vary in speed
+MAX_MS = 1000
+MAX_CRYPTO_MS = 200
+
+EVENT_FIELDS = {
+    'read': {'copy_id': 'copy1', 'has_max_reads': True},
+    'reply': {'content': "Thanks!"},
+    'reaction': {'content': 'like'},
+    'subscription': {},
+    'address': {},
+    'resend': {'content': "Please resend"},
+    'subscribe': {'form': 'form1', 'name': "Sam", 'address': 'sam@stello.test', 'content': ""},
+}
+
+_results = {}
+
+
+@pytest.fixture(scope='module', autouse=True)
+def write_results():
+    yield
+    if os.environ.get('stello_perf_results'):
+        with open(os.environ['stello_perf_results'], 'w') as file:
+            json.dump(_results, file, indent=4)
+
+
+@pytest.mark.parametrize('endpoint', EXPECTED_CALLS)
+def test_aws_calls(stello, aws, endpoint):
+    copy_id = stello.add_copy()
+    if endpoint == 'inviter_image':
+        api_event = stello.image_event(copy_id)
+    else:
+        api_event = stello.event(endpoint, **EVENT_FIELDS[endpoint])
+    aws.calls.clear()
+
+    start = perf_counter()
+    response = responder.entry(api_event, LambdaContext())
+    duration = (perf_counter() - start) * 1000
+    crypto = sum(ms for stage, ms in responder._timings.items()
+        if stage.endswith(('_rsa', '_aes', '_x25519', '_decrypt')))
+
+    _results[endpoint] = {'ms': round(duration, 2), 'crypto_ms': round(crypto, 2),
+        'aws_calls': dict(aws.calls)}
+    assert response['statusCode'] == 200
+    assert dict(aws.calls) == EXPECTED_CALLS[endpoint]
+    assert duration < MAX_MS
+    assert crypto < MAX_CRYPTO_MS
+
+
+def test_warm_config(stello, aws):
+    """Config is only fetched once while warm"""
+    responder.entry(stello.event('reply', content="1"), LambdaContext())
+    responder.entry(stello.event('reply', content="2"), LambdaContext())
+    assert aws.calls['GetObject config'] == 1
+
+
+def test_warm_image(stello, aws):
+    """Image is only decrypted once, and not at all if client already has it"""
+    copy_id = stello.add_copy()
+    first = responder.entry(stello.image_event(copy_id), LambdaContext())
+    second = responder.entry(stello.image_event(copy_id,
+        headers={'if-none-match': first['headers']['etag']}), LambdaContext())
+    assert second['statusCode'] == 304
+    assert 'inviter_decrypt' not in responder._timings
+    assert aws.calls['GetObject messages/invite_images'] == 2
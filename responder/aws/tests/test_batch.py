@@ -0,0 +1,49 @@
+"""Tests for processing multiple events in a single batch request"""
+
+import json
+
+import responder
+from conftest import LambdaContext, USER
+
+
+def test_mixed_items_get_own_status(stello, aws):
+    """Invalid items only fail themselves, and only a status is given for each (no details)"""
+    event = stello.event('batch', events=[
+        {'type': 'reply', 'encrypted': 'x', 'content': "First"},
+        {'type': 'invalid', 'encrypted': 'x'},
+        {'type': 'reaction', 'encrypted': 'x', 'content': 'x' * 26},
+        'not an object',
+        {'type': 'reply', 'encrypted': 'x', 'content': 1},
+        {'type': 'reply', 'encrypted': 'x', 'content': "Last"},
+    ])
+    response = responder.entry(event, LambdaContext())
+    assert response['statusCode'] == 200
+    assert json.loads(response['body']) == {'results': [200, 400, 400, 400, 400, 200]}
+    assert len(stello.keys(f'responses/{USER}/reply/')) == 2
+
+
+def test_config_fetched_once(stello, aws):
+    event = stello.event('batch', events=[
+        {'type': 'reply', 'encrypted': 'x', 'content': str(i)} for i in range(5)])
+    response = responder.entry(event, LambdaContext())
+    assert json.loads(response['body'])['results'] == [200] * 5
+    assert aws.calls['GetObject config'] == 1
+
+
+def test_failed_store_not_notified(stello, aws, monkeypatch):
+    """Item that fails to store gets a 400 (so is retried) and so isn't notified yet either"""
+    put_resp = responder._put_resp
+    def fail_some(config, resp_type, event, *args):
+        if event.get('content') == "Fail":
+            raise Exception("Storing failed")
+        return put_resp(config, resp_type, event, *args)
+    monkeypatch.setattr(responder, '_put_resp', fail_some)
+    event = stello.event('batch', events=[
+        {'type': 'reply', 'encrypted': 'x', 'content': "Fail"},
+        {'type': 'reply', 'encrypted': 'x', 'content': "Thanks!"},
+    ])
+    response = responder.entry(event, LambdaContext())
+    assert json.loads(response['body'])['results'] == [400, 200]
+    assert len(aws.notifications) == 1
+    assert "Thanks!" in aws.notifications[0]['Message']
+    assert "Fail" not in aws.notifications[0]['Message']
@@ -0,0 +1,48 @@
+"""Tests for decoding (and decompressing) request bodies"""
+
+import gzip
+import zlib
+import base64
+
+import responder
+from conftest import LambdaContext, USER, aws_calls
+
+
+def compressed_event(stello, body, encoding):
+    event = stello.event('reply')
+    event['headers']['content-encoding'] = encoding
+    event['body'] = base64.b64encode(body).decode()
+    event['isBase64Encoded'] = True
+    return event
+
+
+def test_gzip_and_deflate_accepted(stello):
+    for encoding, compress in (('gzip', gzip.compress), ('deflate', zlib.compress)):
+        body = stello.event('reply', content=encoding)['body'].encode()
+        event = compressed_event(stello, compress(body), encoding)
+        assert responder.entry(event, LambdaContext())['statusCode'] == 200
+    assert len(stello.keys(f'responses/{USER}/reply/')) == 2
+
+
+def test_decompression_bomb_rejected(stello, aws):
+    """A small body that expands far beyond the max is rejected without fully expanding it"""
+    bomb = gzip.compress(b'\0' * 50 * 1024 * 1024)
+    assert len(bomb) < 60 * 1024
+    response = responder.entry(compressed_event(stello, bomb, 'gzip'), LambdaContext())
+    assert response['statusCode'] == 400
+    assert aws_calls(aws) == 0
+
+
+def test_truncated_body_rejected(stello, aws):
+    """Truncated bodies are rejected even when all the data decompresses (only trailer missing)"""
+    body = gzip.compress(stello.event('reply', content="Thanks!")['body'].encode())
+    response = responder.entry(compressed_event(stello, body[:-4], 'gzip'), LambdaContext())
+    assert response['statusCode'] == 400
+    assert aws_calls(aws) == 0
+
+
+def test_unknown_encoding_rejected(stello, aws):
+    body = stello.event('reply', content="Thanks!")['body'].encode()
+    response = responder.entry(compressed_event(stello, body, 'br'), LambdaContext())
+    assert response['statusCode'] == 400
+    assert aws_calls(aws) == 0
@@ -0,0 +1,62 @@
+"""Regression tests for the time a new container takes to import the responder and respond
+
+Each runs in a fresh process, so nothing is already imported or cached
+
+"""
+
+import sys
+import json
+import subprocess
+
+from conftest import AWS_DIR
+
+
+# Generous limits that only catch large regressions, as CI machines vary in speed
+IMPORT_MAX_MS = 1500
+FIRST_REQUEST_MAX_MS = 1000
+
+COLD_START = '''
+import sys
+import json
+from time import perf_counter
+
+class LambdaContext:
+    def get_remaining_time_in_millis(self):
+        return 10000
+
+start = perf_counter()
+import responder
+imported = perf_counter()
+response = responder.entry(json.loads(sys.argv[1]), LambdaContext())
+responded = perf_counter()
+print(json.dumps({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (responded - imported) * 1000,
+    'status': response['statusCode'],
+    'modules': list(sys.modules),
+}))
+'''
+
+
+def cold_start(api_event):
+    output = subprocess.run([sys.executable, '-c', COLD_START, json.dumps(api_event)],
+        cwd=AWS_DIR / 'function', capture_output=True, check=True, text=True).stdout
+    return json.loads(output.splitlines()[-1])
+
+
+def test_cold_reply(stello, aws):
+    result = cold_start(stello.event('reply', content="Thanks!"))
+    assert result['status'] == 200
+    assert result['import_ms'] < IMPORT_MAX_MS
+    assert result['first_request_ms'] < FIRST_REQUEST_MAX_MS
+
+    # Only imported once needed (Rollbar for errors, template for hosted emails)
+    assert 'rollbar' not in result['modules']
+    assert 'email_template' not in result['modules']
+
+
+def test_cold_image(stello, aws):
+    result = cold_start(stello.image_event(stello.add_copy()))
+    assert result['status'] == 200
+    assert result['import_ms'] < IMPORT_MAX_MS
+    assert result['first_request_ms'] < FIRST_REQUEST_MAX_MS
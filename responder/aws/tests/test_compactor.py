@@ -0,0 +1,36 @@
+"""Tests for compacting old responses into segments"""
+
+import json
+from time import time
+
+import compactor
+from conftest import LambdaContext, USER, RESP_BUCKET
+
+
+def add_responses(aws, count, age):
+    for i in range(count):
+        aws.put(RESP_BUCKET, f'responses/{USER}/reply/{int(time() - age)}_{i:04}', b'{"r": %d}' % i)
+
+
+def test_disabled_by_default(stello, aws):
+    add_responses(aws, 60, 2 * 24 * 60 * 60)
+    compactor.entry({}, LambdaContext())
+    assert len(stello.keys(f'responses/{USER}/')) == 60
+    assert not stello.keys('segments/')
+
+
+def test_old_responses_compacted_outside_responses(stello, aws, monkeypatch):
+    monkeypatch.setattr(compactor, 'COMPACT_ENABLED', True)
+    add_responses(aws, 60, 2 * 24 * 60 * 60)
+    add_responses(aws, 5, 0)  # Too new
+    compactor.entry({}, LambdaContext())
+
+    assert len(stello.keys(f'responses/{USER}/')) == 5
+    segments = stello.keys(f'segments/{USER}/')
+    assert len(segments) == 1
+    header, _, body = aws.objects[(RESP_BUCKET, segments[0])]['body'].partition(b'\n')
+    index = json.loads(header)['index']
+    assert len(index) == 60
+    path, offset, length = index[7]
+    assert path.startswith('reply/')
+    assert json.loads(body[offset:offset+length]) == {'r': 7}
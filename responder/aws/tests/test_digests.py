@@ -0,0 +1,70 @@
+"""Tests for combining notifications into digests"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import responder
+from conftest import LambdaContext, USER
+
+
+@pytest.fixture
+def digests(monkeypatch, stello):
+    monkeypatch.setattr(responder, 'DIGEST_WINDOW', 3600)
+    return stello
+
+
+def reply(stello, i):
+    event = stello.event('reply', ip=f'203.0.113.{i}', content=f"Reply {i}")
+    return responder.entry(event, LambdaContext())['statusCode']
+
+
+def test_parallel_notifications_all_sent(digests, aws, monkeypatch):
+    """Concurrent notifications don't conflict and all are sent in a single digest"""
+    aws.s3_latency = 0.005
+    with ThreadPoolExecutor(20) as executor:
+        assert list(executor.map(lambda i: reply(digests, i), range(20))) == [200] * 20
+    assert len(digests.keys(f'pending_notifications/{USER}/items/')) == 20
+    assert not aws.notifications
+
+    monkeypatch.setattr(responder, 'DIGEST_WINDOW', 0)  # So digest is due
+    responder.flush_notifications({}, LambdaContext())
+    assert len(aws.notifications) == 1
+    for i in range(20):
+        assert f"Reply {i}\n" in aws.notifications[0]['Message']
+    assert not digests.keys('pending_notifications/')
+    assert aws.calls['Rollbar (report)'] == 0
+
+
+def test_digest_not_sent_while_active(digests, aws):
+    reply(digests, 1)
+    responder.flush_notifications({}, LambdaContext())
+    assert not aws.notifications
+    assert len(digests.keys(f'pending_notifications/{USER}/items/')) == 1
+
+
+def test_digest_sent_early_when_large(digests, aws, monkeypatch):
+    monkeypatch.setattr(responder, 'DIGEST_MAX', 3)
+    for i in range(3):
+        reply(digests, i)
+    assert len(aws.notifications) == 1
+    assert not digests.keys('pending_notifications/')
+
+
+def test_failed_digest_kept_for_next_flush(digests, aws, monkeypatch):
+    reply(digests, 1)
+    monkeypatch.setattr(responder, 'DIGEST_WINDOW', 0)
+    def fail(*args):
+        raise Exception("Sending failed")
+    monkeypatch.setattr(responder, '_deliver_notification', fail)
+    responder.flush_notifications({}, LambdaContext())
+    # Claim released but notification kept
+    assert digests.keys('pending_notifications/') == \
+        digests.keys(f'pending_notifications/{USER}/items/')
+    assert len(digests.keys('pending_notifications/')) == 1
+
+    monkeypatch.undo()
+    monkeypatch.setattr(responder, 'DIGEST_WINDOW', 0)
+    responder.flush_notifications({}, LambdaContext())
+    assert len(aws.notifications) == 1
+    assert not digests.keys('pending_notifications/')
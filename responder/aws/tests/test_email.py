@@ -0,0 +1,42 @@
+"""Tests for the size of notification emails (as SES charges by size and clients clip long ones)"""
+
+import html
+import importlib
+
+import pytest
+
+import email_template
+
+
+# Max bytes an email may add to its contents (data URI mode also includes the ~22 KB image)
+OVERHEAD_MAX = 3 * 1024
+IMAGE_MAX = 25 * 1024
+
+
+@pytest.fixture(params=['url', 'data_uri'])
+def template(request, monkeypatch):
+    """Email template as rendered when linking to the image and when embedding it"""
+    if request.param == 'url':
+        monkeypatch.setenv('stello_email_image_url', 'https://stello.test/email.jpg')
+    else:
+        monkeypatch.delenv('stello_email_image_url', raising=False)
+    yield importlib.reload(email_template)
+    monkeypatch.undo()
+    importlib.reload(email_template)
+
+
+@pytest.mark.parametrize('content', ["", "Thanks!", "A long reply\n" * 1000])
+def test_email_size_bounded(template, content):
+    heading = "Someone replied with:"
+    email = template.generate_email(heading, content)
+    overhead = len(email.encode()) - len(html.escape(heading + content).encode()) \
+        - content.count('\n') * 3  # Newlines become <br>
+    limit = OVERHEAD_MAX if template.EMAIL_IMAGE_URL else OVERHEAD_MAX + IMAGE_MAX
+    assert overhead < limit
+    assert (template.EMAIL_IMAGE_URL or 'data:image/jpeg;base64,') in email
+
+
+def test_contents_escaped(template):
+    email = template.generate_email("<b>Sam</b> wants to subscribe", "<script>\nhi")
+    assert '<b>Sam</b>' not in email
+    assert '&lt;script&gt;<br>hi' in email
@@ -0,0 +1,107 @@
+"""Tests that stored responses can be decrypted by the holder of the user's private key"""
+
+import os
+import json
+import zlib
+
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from cryptography.hazmat.primitives.asymmetric.x25519 import X25519PrivateKey, X25519PublicKey
+from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+import responder
+from conftest import LambdaContext, Stello, RESP_BUCKET, USER, url64, resp_key
+
+
+X25519_KEY = X25519PrivateKey.generate()
+
+
+def x25519_stello(aws, **config):
+    public = X25519_KEY.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return Stello(aws, resp_key_x25519=url64(public), **config)
+
+
+def derive_x25519(ephemeral_public):
+    """Derive sym key from an ephemeral public key as the app would, using the private key"""
+    shared = X25519_KEY.exchange(X25519PublicKey.from_public_bytes(ephemeral_public))
+    user_public = X25519_KEY.public_key().public_bytes(Encoding.Raw, PublicFormat.Raw)
+    return HKDF(SHA256(), 32, None, b'stello-resp-x25519' + ephemeral_public + user_public) \
+        .derive(shared)
+
+
+def parse_binary(body):
+    """Split binary envelope into (flags, key field, iv, ciphertext), checking its header"""
+    assert body[0] == 0xB7  # Magic
+    assert body[1] == 1  # Version
+    flags = body[2]
+    key_len = int.from_bytes(body[3:5], 'big')
+    key = body[5:5 + key_len]
+    iv = body[5 + key_len:5 + key_len + 12]
+    return flags, key, iv, body[5 + key_len + 12:]
+
+
+def stored_body(aws, stello, content="Thanks!"):
+    response = responder.entry(stello.event('reply', content=content), LambdaContext())
+    assert response['statusCode'] == 200
+    key, = stello.keys(f'responses/{USER}/reply/')
+    return aws.objects[(RESP_BUCKET, key)]['body']
+
+
+def test_x25519_json_round_trip(aws):
+    body = json.loads(stored_body(aws, x25519_stello(aws)))
+    assert 'encrypted_key' not in body
+    sym_key = derive_x25519(responder._url64_to_bytes(body['ephemeral_key']))
+    encrypted = responder._url64_to_bytes(body['encrypted_data'])
+    data = json.loads(AESGCM(sym_key).decrypt(encrypted[:12], encrypted[12:], None))
+    assert data['event']['content'] == "Thanks!"
+
+
+def test_x25519_binary_round_trip(aws):
+    flags, key, iv, ciphertext = parse_binary(stored_body(aws,
+        x25519_stello(aws, resp_format='binary')))
+    assert flags == 0b10  # X25519 (and not compressed as small)
+    assert len(key) == 32
+    data = json.loads(AESGCM(derive_x25519(key)).decrypt(iv, ciphertext, None))
+    assert data['event']['content'] == "Thanks!"
+
+
+def test_x25519_keys_not_reused(aws):
+    """Each response has its own ephemeral key, so its sym key is never reused"""
+    stello = x25519_stello(aws)
+    for _ in range(2):
+        responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    keys = [json.loads(aws.objects[(RESP_BUCKET, k)]['body'])['ephemeral_key']
+        for k in stello.keys(f'responses/{USER}/reply/')]
+    assert len(set(keys)) == 2
+
+
+def test_json_format_unchanged_by_default(stello, aws):
+    body = json.loads(stored_body(aws, stello))
+    assert set(body) == {'encrypted_data', 'encrypted_key'}
+    key, = stello.keys(f'responses/{USER}/reply/')
+    assert stello.decrypt_resp(key)['event']['content'] == "Thanks!"
+
+
+def test_binary_round_trip(aws):
+    flags, key, iv, ciphertext = parse_binary(stored_body(aws, Stello(aws, resp_format='binary'),
+        content="Thanks!" * 500))
+    assert flags == 0b1  # Compressed (and RSA)
+    sym_key = resp_key().decrypt(key, responder.ASYM_PADDING)
+    data = json.loads(zlib.decompress(AESGCM(sym_key).decrypt(iv, ciphertext, None)))
+    assert data['event']['content'] == "Thanks!" * 500
+
+
+def test_binary_compression_threshold():
+    """Only data at least RESP_COMPRESS_MIN_BYTES is compressed, and only if it gets smaller"""
+    sym_key = AESGCM.generate_key(256)
+    for data, compressed in (
+            (b'a' * (responder.RESP_COMPRESS_MIN_BYTES - 1), False),
+            (b'a' * responder.RESP_COMPRESS_MIN_BYTES, True),
+            (os.urandom(responder.RESP_COMPRESS_MIN_BYTES * 2), False)):  # Incompressible
+        flags, key, iv, ciphertext = parse_binary(
+            responder._encrypt_resp_binary(data, sym_key, b'key'))
+        assert flags == (0b1 if compressed else 0)
+        assert key == b'key'
+        decrypted = AESGCM(sym_key).decrypt(iv, ciphertext, None)
+        assert (zlib.decompress(decrypted) if compressed else decrypted) == data
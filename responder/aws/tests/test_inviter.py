@@ -0,0 +1,30 @@
+"""Tests for serving invite images"""
+
+import responder
+from conftest import LambdaContext
+
+
+def test_unneeded_body_closed(stello, aws, monkeypatch):
+    """If client already has image, its download isn't left open (holding the connection)"""
+    copy_id = stello.add_copy()
+    etag = responder.entry(stello.image_event(copy_id), LambdaContext())['headers']['etag']
+    responder._inviter_cache.clear()
+
+    objects = []
+    get_object = responder.S3.get_object
+    def recording_get_object(**kwargs):
+        objects.append(get_object(**kwargs))
+        return objects[-1]
+    monkeypatch.setattr(responder.S3, 'get_object', recording_get_object)
+    response = responder.entry(stello.image_event(copy_id, headers={'if-none-match': etag}),
+        LambdaContext())
+    assert response['statusCode'] == 304
+    assert objects[0]['Body']._raw_stream.closed
+
+
+def test_cache_size_limited(stello, aws, monkeypatch):
+    monkeypatch.setattr(responder, 'INVITER_CACHE_BYTES', 20000)
+    for i in range(5):
+        responder.entry(stello.image_event(stello.add_copy(f'copy{i}')), LambdaContext())
+    assert sum(len(body) for _, body in responder._inviter_cache.values()) <= 20000
+    assert len(responder._inviter_cache) == 2
@@ -0,0 +1,43 @@
+"""Tests for keeping manifests of stored responses"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+import responder
+from conftest import LambdaContext, USER, RESP_BUCKET
+
+
+@pytest.fixture
+def manifests(monkeypatch, stello):
+    monkeypatch.setattr(responder, 'RESP_MANIFEST', True)
+    return stello
+
+
+def read_manifests(stello):
+    return [json.loads(stello.aws.objects[(RESP_BUCKET, key)]['body'])
+        for key in stello.keys(f'state/{USER}/manifest/')]
+
+
+def test_parallel_responses_all_listed(manifests, aws):
+    aws.s3_latency = 0.005
+    def reaction(i):
+        event = manifests.event('reaction', ip=f'203.0.113.{i}', content='like')
+        return responder.entry(event, LambdaContext())['statusCode']
+    with ThreadPoolExecutor(20) as executor:
+        assert list(executor.map(reaction, range(20))) == [200] * 20
+    listed = [path for manifest in read_manifests(manifests) for path in manifest['reaction']]
+    stored = manifests.keys(f'responses/{USER}/reaction/')
+    assert sorted(f'responses/{USER}/reaction/{path}' for path in listed) == stored
+
+
+def test_conflict_keeps_listed(manifests, monkeypatch):
+    """If can't add to a manifest it is marked incomplete without losing what it lists"""
+    responder._add_to_manifest(USER, 'reply', 'first', 1000)
+    put_state = responder._put_state
+    monkeypatch.setattr(responder, 'STATE_BACKOFF', (0, 0))
+    monkeypatch.setattr(responder, '_put_state',
+        lambda key, state, etag: 'incomplete' in state and put_state(key, state, etag))
+    responder._add_to_manifest(USER, 'reply', 'second', 1000)
+    assert read_manifests(manifests) == [{'reply': ['first'], 'incomplete': True}]
@@ -0,0 +1,59 @@
+"""Tests for notifying the user of responses"""
+
+from time import monotonic, sleep
+
+import responder
+from conftest import LambdaContext, Stello, USER
+
+
+def test_not_notified_if_not_stored(aws):
+    """Recipient retries if storing fails, so notifying would result in duplicates"""
+    stello = Stello(aws, resp_key_public='invalid')
+    response = responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert response['statusCode'] == 400
+    assert not aws.notifications
+
+
+def test_notified_with_contents(stello, aws):
+    responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert len(aws.notifications) == 1
+    assert "Thanks!" in aws.notifications[0]['Message']
+
+
+def test_count_failure_still_stored(aws, monkeypatch):
+    """Failing to update counts is reported but doesn't fail the already stored response"""
+    def fail(*args):
+        raise Exception("Counting failed")
+    monkeypatch.setattr(responder, '_increment_resp_count', fail)
+    stello = Stello(aws, notify_include_contents=False)
+    response = responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert response['statusCode'] == 200
+    assert len(stello.keys(f'responses/{USER}/reply/')) == 1
+    assert len(responder._reports_seen) == 1
+
+
+def test_counts_correct_after_settings_change(aws):
+    """Responses stored while counts weren't needed are still counted once they are"""
+    counting = Stello(aws, notify_include_contents=False)
+    responder.entry(counting.event('reply', content="1"), LambdaContext())
+    with_contents = Stello(aws, notify_include_contents=True)
+    for i in range(3):
+        responder.entry(with_contents.event('reply', content=str(i)), LambdaContext())
+    counting = Stello(aws, notify_include_contents=False)
+    responder.entry(counting.event('reply', content="5"), LambdaContext())
+    assert aws.notifications[-1]['Subject'].startswith("Stello: 5 new replies")
+
+
+def test_notified_while_bookkeeping(stello, aws, monkeypatch):
+    """Notification is sent once stored, without waiting for manifests etc. to be updated"""
+    notified_during = []
+    def slow_manifest(*args):
+        deadline = monotonic() + 2
+        while not aws.notifications and monotonic() < deadline:
+            sleep(0.01)
+        notified_during.append(bool(aws.notifications))
+    monkeypatch.setattr(responder, 'RESP_MANIFEST', True)
+    monkeypatch.setattr(responder, '_add_to_manifest', slow_manifest)
+    response = responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert response['statusCode'] == 200
+    assert notified_during == [True]
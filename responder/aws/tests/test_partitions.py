@@ -0,0 +1,58 @@
+"""Tests for spreading stored responses across partitions (sub-prefixes) of their type"""
+
+import hashlib
+
+import responder
+from conftest import LambdaContext, Stello, RESP_BUCKET, USER
+
+
+def test_unpartitioned_by_default(stello):
+    responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    key, = stello.keys(f'responses/{USER}/reply/')
+    assert key.count('/') == 3
+
+
+def test_partitioned_layout(aws):
+    stello = Stello(aws, resp_partitions=4)
+    for _ in range(10):
+        responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    keys = stello.keys(f'responses/{USER}/reply/')
+    assert len(keys) == 10
+    for key in keys:
+        partition, name = key.split('/')[3:]
+        digest = hashlib.sha256(name.encode()).digest()
+        assert partition == f'{int.from_bytes(digest[:4], "big") % 4:02x}'
+
+
+def test_partitions_capped():
+    name = '1700000000_x'
+    for partitions in (None, 0, 1):
+        assert responder._resp_partition_path({'resp_partitions': partitions}, name) == name
+    path = responder._resp_partition_path({'resp_partitions': 10000}, name)
+    partition = path.partition('/')[0]
+    assert len(partition) == 2 and int(partition, 16) < responder.RESP_PARTITIONS_MAX
+
+
+def test_listing_merges_legacy_and_partitioned(aws):
+    """Responses stored before partitioning was enabled are listed in order with later ones"""
+    prefix = f'responses/{USER}/reply/'
+    stored = [
+        f'{prefix}1700000000_a',
+        f'{prefix}03/1700000001_b',
+        f'{prefix}1700000002_c',
+        f'{prefix}00/1700000003_d',
+        f'{prefix}03/1700000004_e',
+        f'{prefix}1700000005_f',
+    ]
+    for key in reversed(stored):
+        aws.put(RESP_BUCKET, key, b'resp')
+    assert list(responder._list_resp_keys(USER, 'reply')) == stored
+
+
+def test_listing_unpartitioned(aws):
+    prefix = f'responses/{USER}/reply/'
+    stored = [f'{prefix}1700000000_a', f'{prefix}1700000001_b']
+    for key in stored:
+        aws.put(RESP_BUCKET, key, b'resp')
+    assert list(responder._list_resp_keys(USER, 'reply')) == stored
+    assert list(responder._list_resp_keys(USER, 'reaction')) == []
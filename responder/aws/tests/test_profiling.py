@@ -0,0 +1,29 @@
+"""Tests for profiling a sample of requests"""
+
+import json
+
+import pytest
+
+import responder
+
+
+@pytest.fixture
+def profiled(monkeypatch, aws):
+    monkeypatch.setattr(responder, 'PROFILE_RATE', 1)
+    return responder._profiled(lambda event, context: 'result')
+
+
+def test_profile_logged(profiled, capsys):
+    assert profiled({'requestContext': {'http': {'path': '/responder/read'}}}, None) == 'result'
+    summary = json.loads(capsys.readouterr().out)['profile']
+    assert summary['path'] == '/responder/read'
+    assert summary['functions']
+
+
+def test_failed_save_doesnt_replace_result(profiled, monkeypatch):
+    def fail(*args):
+        raise OSError("Disk full")
+    monkeypatch.setattr(responder, '_save_profile', fail)
+    assert profiled({}, None) == 'result'
+    assert len(responder._reports_seen) == 1
+    assert profiled({}, None) == 'result'  # Can still profile later invocations
@@ -0,0 +1,35 @@
+"""Tests for shedding abusive load with rate limits"""
+
+import json
+
+import responder
+from conftest import LambdaContext
+
+
+def test_images_not_limited_by_ip(stello, aws):
+    """Email providers fetch images for many recipients from the same IP"""
+    copies = [stello.add_copy(f'copy{i}') for i in range(150)]
+    statuses = [responder.entry(stello.image_event(copy_id), LambdaContext())['statusCode']
+        for copy_id in copies]
+    assert statuses == [200] * 150
+
+
+def test_images_limited_by_copy(stello, aws):
+    copy_id = stello.add_copy()
+    statuses = [responder.entry(stello.image_event(copy_id, ip=f'203.0.113.{i}'),
+        LambdaContext())['statusCode'] for i in range(40)]
+    assert statuses[:30] == [200] * 30
+    assert statuses.count(429) >= 5  # Some tokens may have been added back while running
+
+
+def test_batch_items_limited_by_copy(stello, aws):
+    copy_id = stello.add_copy(max_reads=1000)
+    results = []
+    for _ in range(4):
+        event = stello.event('batch', events=[{'type': 'read', 'encrypted': 'x',
+            'copy_id': copy_id, 'has_max_reads': True}] * 10)
+        response = responder.entry(event, LambdaContext())
+        results += json.loads(response['body'])['results']
+    assert results[:30] == [200] * 30
+    assert results.count(429) >= 5  # Some tokens may have been added back while running
+    assert aws.calls['Rollbar (report)'] == 0
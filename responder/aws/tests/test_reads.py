@@ -0,0 +1,59 @@
+"""Tests for tracking reads of copies and deleting them once reached their max reads"""
+
+import json
+from concurrent.futures import ThreadPoolExecutor
+
+import responder
+from conftest import LambdaContext, USER, MSGS_BUCKET, RESP_BUCKET
+
+
+def test_parallel_reads_counted_exactly(stello, aws):
+    """No reads are lost or fail when many are reported at once"""
+    aws.s3_latency = 0.005  # Spread requests out a little like real S3 would
+    copy_id = stello.add_copy(max_reads=1000)
+    reads = 25  # Within the per-copy rate limit
+    with ThreadPoolExecutor(reads) as executor:
+        responses = list(executor.map(
+            lambda i: responder.entry(stello.event('read', ip=f'203.0.113.{i}', copy_id=copy_id,
+                has_max_reads=True), LambdaContext()),
+            range(reads)))
+    assert [r['statusCode'] for r in responses] == [200] * reads
+    assert aws.calls['Rollbar (report)'] == 0
+    state = json.loads(aws.objects[(RESP_BUCKET, f'state/{USER}/reads/{copy_id}')]['body'])
+    assert state['reads'] == reads
+    assert len(stello.keys(f'responses/{USER}/read/')) == reads
+    assert aws.calls['PutObject state/reads'] > reads  # Did actually conflict
+
+
+def test_max_reads_deletes_copy_and_state(stello, aws):
+    copy_id = stello.add_copy(reads=1, max_reads=2)
+    event = stello.event('read', copy_id=copy_id, has_max_reads=True)
+
+    responder.entry(event, LambdaContext())
+    assert not stello.keys(f'state/{USER}/reads/')
+    assert (MSGS_BUCKET, f'messages/{USER}/copies/{copy_id}') not in aws.objects
+    assert (MSGS_BUCKET, f'messages/{USER}/invite_images/{copy_id}') not in aws.objects
+
+    # Later reads don't recreate the state, but are still stored
+    assert responder.entry(event, LambdaContext())['statusCode'] == 200
+    assert not stello.keys(f'state/{USER}/reads/')
+    assert len(stello.keys(f'responses/{USER}/read/')) == 2
+
+
+def test_read_state_tagged_with_lifespan(stello, aws):
+    copy_id = stello.add_copy()
+    aws.objects[(MSGS_BUCKET, f'messages/{USER}/copies/{copy_id}')]['tags']['stello-lifespan'] = '7'
+    responder.entry(stello.event('read', copy_id=copy_id, has_max_reads=True), LambdaContext())
+    responder.entry(stello.event('read', copy_id=copy_id, has_max_reads=True), LambdaContext())
+    state = aws.objects[(RESP_BUCKET, f'state/{USER}/reads/{copy_id}')]
+    assert state['tags'] == {'stello-lifespan': '7'}
+
+
+def test_only_first_read_gets_tags(stello, aws):
+    """Copy's tags are only needed to create the state, so later reads cost the same as before"""
+    copy_id = stello.add_copy()
+    for _ in range(3):
+        responder.entry(stello.event('read', copy_id=copy_id, has_max_reads=True), LambdaContext())
+    assert aws.calls['GetObjectTagging messages/copies'] == 1
+    assert aws.calls['GetObject state/reads'] == 3
+    assert aws.calls['PutObject state/reads'] == 3
@@ -0,0 +1,59 @@
+"""Tests for reporting errors without delaying responses"""
+
+from time import perf_counter
+
+import pytest
+
+import responder
+from conftest import LambdaContext, Stello
+
+
+def test_slow_reporting_doesnt_delay_response(stello, aws):
+    """If Rollbar is slow, reports are left to finish during later invocations"""
+    aws.report_latency = 2
+    start = perf_counter()
+    response = responder.entry(stello.event('invalid'), LambdaContext())
+    duration = perf_counter() - start
+    assert response['statusCode'] == 400
+    assert duration < 1
+    assert len(responder._reports_pending) == 1
+
+    # Unsent report is still sent (and no longer pending after a later invocation)
+    responder._flush_reports(None)
+    assert aws.calls['Rollbar (report)'] == 1
+    responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert not responder._reports_pending
+
+
+def test_reports_deduped(stello, aws):
+    for _ in range(3):
+        responder.entry(stello.event('invalid'), LambdaContext())
+    responder._flush_reports(None)
+    assert aws.calls['Rollbar (report)'] == 1
+    assert list(responder._reports_seen.values())[0][1] == 2  # Suppressed count
+
+
+def test_reports_limited_per_error(aws, monkeypatch):
+    """Frequent errors are limited without preventing different errors from being reported"""
+    monkeypatch.setattr(responder, 'REPORT_DEDUPE_WINDOW', 0)
+    monkeypatch.setattr(responder, 'REPORT_LIMIT', (0, 1))
+    stello = Stello(aws)
+    for _ in range(3):
+        responder.entry(stello.event('invalid'), LambdaContext())
+    unstorable = Stello(aws, resp_key_public='invalid')
+    responder.entry(unstorable.event('reply', content="Thanks!"), LambdaContext())
+    responder._flush_reports(None)
+    assert aws.calls['Rollbar (report)'] == 2
+
+
+def test_failed_invocation_waits_for_reports(stello, aws):
+    """If invocation fails, reports are sent before it ends, as may not be invoked again"""
+    aws.report_latency = 0.5
+    responder.entry(stello.event('invalid'), LambdaContext())
+    assert responder._reports_pending
+    malformed = stello.event('reply', content="Thanks!")
+    del malformed['headers']
+    with pytest.raises(KeyError):
+        responder.entry(malformed, LambdaContext())
+    assert aws.calls['Rollbar (report)'] == 1
+    assert not responder._reports_pending
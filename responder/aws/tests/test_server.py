@@ -0,0 +1,55 @@
+"""Tests for running the responder as a long-running HTTP server"""
+
+import socket
+from time import sleep
+from threading import Thread
+from http.client import HTTPConnection
+
+import server
+
+
+def start_server(workers, queue):
+    pooled = server.PooledHTTPServer(('127.0.0.1', 0), server.ResponderHandler, workers, queue)
+    Thread(target=pooled.serve_forever, daemon=True).start()
+    return pooled
+
+
+def test_rejects_when_queue_full(aws):
+    """Connections beyond the workers and queue get a 503 rather than waiting indefinitely"""
+    pooled = start_server(workers=1, queue=0)
+    try:
+        idle = socket.create_connection(pooled.server_address)  # Occupies the only worker
+        conn = HTTPConnection(*pooled.server_address, timeout=2)
+        conn.request('GET', '/')
+        assert conn.getresponse().status == 503
+        idle.close()
+    finally:
+        pooled.shutdown()
+        pooled.server_close()
+
+
+def test_kept_alive_unless_others_waiting(aws):
+    """Idle connections only hold a worker while no other connections need it"""
+    pooled = start_server(workers=1, queue=1)
+    try:
+        conn = HTTPConnection(*pooled.server_address, timeout=2)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        response.read()
+        assert response.getheader('connection') != 'close'
+
+        # Same connection is closed after its next request if another connection is queued
+        waiting = HTTPConnection(*pooled.server_address, timeout=2)
+        waiting.connect()
+        while not pooled.busy():
+            sleep(0.01)
+        conn.request('GET', '/')
+        response = conn.getresponse()
+        response.read()
+        assert response.getheader('connection') == 'close'
+        waiting.request('GET', '/')
+        assert waiting.getresponse().status == 400
+        waiting.close()
+    finally:
+        pooled.shutdown()
+        pooled.server_close()
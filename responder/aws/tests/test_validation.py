@@ -0,0 +1,32 @@
+"""Tests that invalid requests are rejected before costing any AWS requests"""
+
+import json
+
+import pytest
+
+import responder
+from conftest import LambdaContext, aws_calls
+
+
+@pytest.mark.parametrize('resp_type, fields', [
+    ('invalid', {}),  # Unknown type
+    ('read', {'has_max_reads': False}),  # Missing field
+    ('read', {'copy_id': 'copy1', 'has_max_reads': 'no'}),  # Field of wrong type
+    ('read', {'copy_id': '../copy1', 'has_max_reads': False}),  # Field with invalid value
+    ('reply', {'content': 1}),
+    ('reaction', {'content': 'x' * 26}),  # Too long
+    ('reaction', {'content': 'Thanks!'}),  # Not a reaction code
+    ('subscribe', {'address': 'a@b.test'}),
+])
+def test_invalid_requests_cost_no_aws_calls(stello, aws, resp_type, fields):
+    response = responder.entry(stello.event(resp_type, **fields), LambdaContext())
+    assert response['statusCode'] == 400
+    assert aws_calls(aws) == 0
+
+
+def test_invalid_common_fields_cost_no_aws_calls(stello, aws):
+    for body in ([], {'encrypted': 'x'}, {'config_secret': 1, 'encrypted': 'x'}):
+        event = stello.event('reply')
+        event['body'] = json.dumps(body)
+        assert responder.entry(event, LambdaContext())['statusCode'] == 400
+    assert aws_calls(aws) == 0
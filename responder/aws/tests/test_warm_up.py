@@ -0,0 +1,23 @@
+"""Tests for warming up a container before it handles requests"""
+
+import responder
+from conftest import LambdaContext, url64
+
+
+def test_warm_up_stores_nothing(stello, aws):
+    responder._aws_client.cache_clear()
+    objects = dict(aws.objects)
+    assert responder.entry({'connections': 2}, LambdaContext()) == {'statusCode': 200}
+    assert aws.objects == objects
+    assert set(aws.calls) == {'HeadObject warmup'}
+    assert aws.calls['HeadObject warmup'] == 4  # Each bucket twice
+    assert responder._aws_client.cache_info().currsize == 1  # Notifier client created
+
+
+def test_warm_up_caches_config(stello, aws):
+    warm = responder.entry({'config_secret': url64(stello.config_secret)}, LambdaContext())
+    assert warm == {'statusCode': 200}
+    assert aws.calls['GetObject config'] == 1
+    responder.entry(stello.event('reply', content="Thanks!"), LambdaContext())
+    assert aws.calls['GetObject config'] == 1
+    assert aws.calls['PutObject responses/reply'] == 1